@@ -1,4 +1,5 @@
 import os
+import dataclasses
 from dataclasses import dataclass
 from pathlib import Path
 from dotenv import load_dotenv
@@ -6,6 +7,9 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# Fields that default to None and are resolved from other fields in __post_init__
+DERIVED_FIELDS = ("GAME_EXE", "RIG_FOV", "CAPTURE_FRAMERATE", "DEMO_TICKRATE")
+
 @dataclass
 class RenderConfig:
     # --- PATHS ---
@@ -19,15 +23,55 @@ class RenderConfig:
     
     # --- RENDER SETTINGS ---
     DEMO_FILE: str = os.getenv("DEMO_FILE", "my_gameplay")
+    # Optional playlist (comma separated): each demo becomes one segment of the final video
+    DEMO_FILES: str = os.getenv("DEMO_FILES", "")
+    # Tick range to render (0 = from the usual start tick / until the demo ends).
+    # Frames keep the numbering of a full render, so a partial render splices into it.
+    START_TICK: int = int(os.getenv("START_TICK", "0"))
+    END_TICK: int = int(os.getenv("END_TICK", "0"))
+    # Demo ticks per second (default by engine: HL2 66.67, Portal 2 60)
+    DEMO_TICKRATE: float = float(os.getenv("DEMO_TICKRATE")) if os.getenv("DEMO_TICKRATE") else None
+    # Crossfade at each join between segments, in whole seconds (0 = hard cut)
+    CROSSFADE_SECONDS: int = int(os.getenv("CROSSFADE_SECONDS", "0"))
     OUTPUT_NAME: str = os.getenv("OUTPUT_NAME", "final_panorama")
     FRAMERATE: int = int(os.getenv("FRAMERATE", "60"))
+    # Rate the game captures at (host_framerate). Below FRAMERATE, the stitcher
+    # interpolates up to FRAMERATE. Default None = same as FRAMERATE (no interpolation).
+    CAPTURE_FRAMERATE: int = int(os.getenv("CAPTURE_FRAMERATE")) if os.getenv("CAPTURE_FRAMERATE") else None
+    # 'mci' (motion compensated, slow), 'blend' (frame blending, fast) or 'dup' (repeat frames)
+    INTERPOLATION: str = os.getenv("INTERPOLATION", "mci")
+    # 'stitched' (once on the stitched video) or 'faces' (per face before stitching, slower, no projection distortion)
+    INTERPOLATION_STAGE: str = os.getenv("INTERPOLATION_STAGE", "stitched")
     
     # Resolution of ONE face
     CUBE_FACE_SIZE: int = int(os.getenv("CUBE_FACE_SIZE", "640"))
     
+    # --- WATCHDOG ---
+    # Seconds without a new frame before a game instance is considered hung and killed
+    WATCHDOG_TIMEOUT: float = float(os.getenv("WATCHDOG_TIMEOUT", "120"))
+    # Retries per face after a hang or crash; the wait doubles each time starting at RETRY_BACKOFF seconds
+    RENDER_RETRIES: int = int(os.getenv("RENDER_RETRIES", "2"))
+    RETRY_BACKOFF: float = float(os.getenv("RETRY_BACKOFF", "30"))
+
     # --- FFMPEG SETTINGS ---
     FFMPEG_BIN: str = os.getenv("FFMPEG_BIN", "ffmpeg")
-    TEMP_DIR: Path = Path("temp_render_files")
+    TEMP_DIR: Path = Path(os.getenv("TEMP_DIR", "temp_render_files"))
+    OUTPUT_DIR: Path = Path(os.getenv("OUTPUT_DIR", "output"))
+
+    # --- STORAGE TIERS ---
+    # Bulk volumes for intermediate frames (comma separated). Faces are striped across them;
+    # empty = everything in TEMP_DIR. The face -> volume index lives in TEMP_DIR.
+    TEMP_VOLUMES: str = os.getenv("TEMP_VOLUMES", "")
+    # 'round_robin' or 'free_space' (most free space at the time the face is stored)
+    TEMP_STRIPING: str = os.getenv("TEMP_STRIPING", "round_robin")
+    # RAM disk / tmpfs for the raw capture; linked into the mod folder as 'panorama_capture'
+    STAGING_DIR: str = os.getenv("STAGING_DIR", "")
+
+    # Intermediate frame format: 'jpeg' (convert after each face, less disk)
+    # or 'tga' (keep raw frames and stream them into the stitcher, no re-encode)
+    STITCH_SOURCE: str = os.getenv("STITCH_SOURCE", "jpeg")
+    # Frames memory-mapped ahead of the pipe writer, per face (tga only)
+    RAW_READAHEAD_FRAMES: int = int(os.getenv("RAW_READAHEAD_FRAMES", "8"))
 
     # --- V360 EXTENDED SETTINGS ---
     PANORAMA_MODE: str = os.getenv("PANORAMA_MODE", "sphere") # sphere, cube
@@ -35,69 +79,107 @@ class RenderConfig:
     # FOV for the input camera
     # If using cube mode, we generally want 90 FOV.
     # If using sphere mode (22 shots), we want 60 FOV.
-    _default_fov = "90.0" if os.getenv("PANORAMA_MODE") == "cube" else "60.0"
-    RIG_FOV: float = float(os.getenv("RIG_FOV", _default_fov))
+    # Default to None, resolve in post_init from PANORAMA_MODE if not set
+    RIG_FOV: float = float(os.getenv("RIG_FOV")) if os.getenv("RIG_FOV") else None
     
     # Blend width needs to be sufficient for the overlap
     BLEND_WIDTH: float = float(os.getenv("BLEND_WIDTH", "0.20"))
 
+    # Output projection: 'equirect', 'cubemap' (3x2) or 'eac' (equi-angular cubemap, 3x2).
+    # Cube outputs are sized from CUBE_FACE_SIZE and RIG_FOV to keep the captured pixel density.
+    OUTPUT_PROJECTION: str = os.getenv("OUTPUT_PROJECTION", "equirect")
+
+    # --- TILED STITCHING ---
+    # Number of vertical stripes the equirect canvas is stitched in.
+    # 0 = auto: split only when the output is wider than STITCH_TILE_WIDTH.
+    STITCH_TILES: int = int(os.getenv("STITCH_TILES", "0"))
+    STITCH_TILE_WIDTH: int = int(os.getenv("STITCH_TILE_WIDTH", "8192"))
+    # 'assemble' (stack stripes into one video) or 'streams' (one video stream per stripe)
+    TILE_OUTPUT: str = os.getenv("TILE_OUTPUT", "assemble")
+
     def __post_init__(self):
+        # Paths may be given as strings when overriding fields
+        self.GAME_ROOT = Path(self.GAME_ROOT)
+        self.TEMP_DIR = Path(self.TEMP_DIR)
+        self.OUTPUT_DIR = Path(self.OUTPUT_DIR)
+        self.output_path = self.OUTPUT_DIR
+
+        # Remembered so copies resolve these again from their own fields
+        self._derived = {name for name in DERIVED_FIELDS if getattr(self, name) is None}
+
         if self.GAME_EXE is None:
             if self.ENGINE_TYPE == "portal2":
                 self.GAME_EXE = self.GAME_ROOT / "portal2.exe"
             else:
                 self.GAME_EXE = self.GAME_ROOT / "hl2.exe"
 
-        self.output_path = Path("output")
-        self.output_path.mkdir(exist_ok=True)
-        self.TEMP_DIR.mkdir(exist_ok=True)
+        if self.RIG_FOV is None:
+            self.RIG_FOV = 90.0 if self.PANORAMA_MODE == "cube" else 60.0
 
-cfg = RenderConfig()
+        if self.CAPTURE_FRAMERATE is None:
+            self.CAPTURE_FRAMERATE = self.FRAMERATE
+
+        if self.DEMO_TICKRATE is None:
+            self.DEMO_TICKRATE = 60.0 if self.ENGINE_TYPE == "portal2" else 66.6667
+
+        self.GAME_EXE = Path(self.GAME_EXE)
+
+    def copy(self, **overrides) -> "RenderConfig":
+        """
+        Returns an independent copy with `overrides` applied. Fields that were derived
+        (not set explicitly) are derived again, so e.g. overriding PANORAMA_MODE also updates RIG_FOV.
+        """
+        resets = {name: None for name in self._derived if name not in overrides}
+        return dataclasses.replace(self, **resets, **overrides)
 
 # --- ANGLES GENERATION ---
-PANORAMA_FACES = {}
+def build_panorama_faces(mode: str) -> dict:
+    """Returns {face_name: (pitch, yaw, roll)} for a capture mode."""
+    faces = {}
 
-if cfg.PANORAMA_MODE == "cube":
-    # Cubic 6-shot layout (FOV 90)
-    # Standard cube faces: Front, Right, Back, Left, Up, Down
-    # Pitch: Positive=Up, Negative=Down (in this config logic)
-    # Yaw: 0=Front, 90=Right, 180=Back, 270=Left
+    if mode == "cube":
+        # Cubic 6-shot layout (FOV 90)
+        # Standard cube faces: Front, Right, Back, Left, Up, Down
+        # Pitch: Positive=Up, Negative=Down (in this config logic)
+        # Yaw: 0=Front, 90=Right, 180=Back, 270=Left
     
-    PANORAMA_FACES["front"] = (0, 0, 0)
-    PANORAMA_FACES["right"] = (0, 90, 0)
-    PANORAMA_FACES["back"]  = (0, 180, 0)
-    PANORAMA_FACES["left"]  = (0, 270, 0)
-    PANORAMA_FACES["up"]    = (90, 0, 0)
-    PANORAMA_FACES["down"]  = (-90, 0, 0)
-
-else:
-    # default to "sphere" - 22 shots, 60 FOV
-    # Optimal robust layout: 
-    # - Equator (Pitch 0): 8 shots (45 deg step)
-    # - Mid-Latitudes (Pitch +/- 45): 6 shots each (60 deg step)
-    # - Poles (Pitch +/- 90): 1 shot each
+        faces["front"] = (0, 0, 0)
+        faces["right"] = (0, 90, 0)
+        faces["back"]  = (0, 180, 0)
+        faces["left"]  = (0, 270, 0)
+        faces["up"]    = (90, 0, 0)
+        faces["down"]  = (-90, 0, 0)
+
+    else:
+        # default to "sphere" - 22 shots, 60 FOV
+        # Optimal robust layout: 
+        # - Equator (Pitch 0): 8 shots (45 deg step)
+        # - Mid-Latitudes (Pitch +/- 45): 6 shots each (60 deg step)
+        # - Poles (Pitch +/- 90): 1 shot each
     
-    # 1. Equator Ring (8 shots)
-    for i in range(8):
-        yaw = i * 45
-        name = f"row0_yaw{yaw}"
-        PANORAMA_FACES[name] = (0, yaw, 0) # Pitch, Yaw, Roll
-
-    # 2. Upper Ring (Pitch 45, 6 shots)
-    for i in range(6):
-        yaw = i * 60
-        name = f"rowUp_yaw{yaw}"
-        PANORAMA_FACES[name] = (45, yaw, 0)
-
-    # 3. Lower Ring (Pitch -45, 6 shots)
-    for i in range(6):
-        yaw = i * 60
-        name = f"rowDown_yaw{yaw}"
-        PANORAMA_FACES[name] = (-45, yaw, 0)
-
-    # 4. Caps
-    PANORAMA_FACES["cap_up"] = (90, 0, 0)
-    PANORAMA_FACES["cap_down"] = (-90, 0, 0)
+        # 1. Equator Ring (8 shots)
+        for i in range(8):
+            yaw = i * 45
+            name = f"row0_yaw{yaw}"
+            faces[name] = (0, yaw, 0) # Pitch, Yaw, Roll
+
+        # 2. Upper Ring (Pitch 45, 6 shots)
+        for i in range(6):
+            yaw = i * 60
+            name = f"rowUp_yaw{yaw}"
+            faces[name] = (45, yaw, 0)
+
+        # 3. Lower Ring (Pitch -45, 6 shots)
+        for i in range(6):
+            yaw = i * 60
+            name = f"rowDown_yaw{yaw}"
+            faces[name] = (-45, yaw, 0)
+
+        # 4. Caps
+        faces["cap_up"] = (90, 0, 0)
+        faces["cap_down"] = (-90, 0, 0)
+
+    return faces
 
 def get_v360_angle(source_pitch, source_yaw):
     """
@@ -2,20 +2,29 @@ import subprocess
 import time
 import shutil
 from pathlib import Path
-from config import cfg, PANORAMA_FACES
-from src.utils import logger
 from src.window_input import press_key
+from src.watchdog import FrameWatchdog, RenderCrashError
+from src.raw_frames import list_tga_frames
+
+# Tick the full render starts from; frame 0 of every face sequence
+DEFAULT_START_TICK = 1
 
 class EngineController:
     """Controls the game engine (HL2) to render frames."""
     
-    def __init__(self):
-        self.cfg_path = cfg.GAME_ROOT / cfg.MOD_DIR / "cfg"
+    def __init__(self, job):
+        self.job = job
+        self.cfg = job.cfg
+        self.logger = job.logger
+        self.cfg_path = self.cfg.GAME_ROOT / self.cfg.MOD_DIR / "cfg"
         
         if not self.cfg_path.exists():
-            logger.warning(f"Config directory not found at {self.cfg_path}. Attempting to create it.")
+            self.logger.warning(f"Config directory not found at {self.cfg_path}. Attempting to create it.")
             self.cfg_path.mkdir(parents=True, exist_ok=True)
 
+        # Optional RAM-disk staging for the raw capture; linked by RenderJob while it holds the game
+        self.capture_dir = None
+
     def _generate_render_cfg(self, face_name: str, angles: tuple) -> str:
         """
         Creates a .cfg file with commands to render one face.
@@ -30,7 +39,8 @@ class EngineController:
         
         # Use the configured RIG_FOV (60.0)
         # Source fov command usually sets horizontal FOV.
-        REAL_FOV = cfg.RIG_FOV
+        REAL_FOV = self.cfg.RIG_FOV
+        start_tick, _, _ = self.job.frame_window(DEFAULT_START_TICK)
 
         content = [
             "sv_cheats 1",
@@ -48,17 +58,17 @@ class EngineController:
             "mat_vignette_enable 0",
             
             # F8: Play Demo
-            f"bind F8 \"playdemo {cfg.DEMO_FILE}\"",
+            f"bind F8 \"playdemo {self.cfg.DEMO_FILE}\"",
             
             # F9: Prepare (Reset constraints)
             f"bind F9 \"sv_cheats 1; mat_vsync 0; fps_max 0; fov {REAL_FOV}; thirdperson; thirdperson_mayamode 1; c_mindistance -100; c_minyaw -360; c_maxyaw 360; c_minpitch -180; c_maxpitch 180\"",
             
             # F10: Setup Face
             # We use {-pitch} because Source Engine positive pitch is DOWN, but our config uses positive for UP.
-            f"bind F10 \"demo_gototick 1; demo_pause; sv_cheats 1; fov {REAL_FOV}; thirdperson; thirdperson_mayamode 1; c_mindistance -100; c_minyaw -360; c_maxyaw 360; c_minpitch -180; c_maxpitch 180; cam_idealdist 0; cam_idealdistright 0; cam_idealdistup 0; cam_collision 0; cam_ideallag 0; cam_snapto 1; cam_idealpitch {-pitch}; cam_idealyaw {yaw}; thirdperson; demo_fov_override 0\"",
+            f"bind F10 \"demo_gototick {start_tick}; demo_pause; sv_cheats 1; fov {REAL_FOV}; thirdperson; thirdperson_mayamode 1; c_mindistance -100; c_minyaw -360; c_maxyaw 360; c_minpitch -180; c_maxpitch 180; cam_idealdist 0; cam_idealdistright 0; cam_idealdistup 0; cam_collision 0; cam_ideallag 0; cam_snapto 1; cam_idealpitch {-pitch}; cam_idealyaw {yaw}; thirdperson; demo_fov_override 0\"",
 
             # F11: Record
-            f"bind F11 \"fov {REAL_FOV}; thirdperson_mayamode 1; host_framerate {cfg.FRAMERATE}; startmovie {face_name} tga wav; demo_resume\"",
+            f"bind F11 \"fov {REAL_FOV}; thirdperson_mayamode 1; host_framerate {self.cfg.CAPTURE_FRAMERATE}; startmovie {self.job.storage.capture_name(face_name)} tga wav; demo_resume\"",
             
             # F12: Stop Record and Quit
             "bind F12 \"endmovie; quit\""
@@ -69,14 +79,20 @@ class EngineController:
             with open(file_path, "w") as f:
                 f.write("\n".join(content))
         except IOError as e:
-            logger.error(f"Failed to write config file {file_path}: {e}")
+            self.logger.error(f"Failed to write config file {file_path}: {e}")
             raise
         
         return cfg_filename
 
+    def _search_paths(self) -> list:
+        """Folders the engine may write movie frames into."""
+        paths = [self.cfg.GAME_ROOT / self.cfg.MOD_DIR, self.cfg.GAME_ROOT / "hl2"]
+        if self.capture_dir:
+            paths.insert(0, self.capture_dir)
+        return list(dict.fromkeys(paths))
+
     def _cleanup_game_artifacts(self, face_name: str):
-        search_paths = [cfg.GAME_ROOT / cfg.MOD_DIR, cfg.GAME_ROOT / "hl2"]
-        for mod_path in search_paths:
+        for mod_path in self._search_paths():
             if not mod_path.exists(): continue
             for f in mod_path.glob(f"{face_name}*.tga"):
                 try: f.unlink()
@@ -87,54 +103,71 @@ class EngineController:
                 except: pass
 
     def render_face(self, face_name: str):
-        if face_name not in PANORAMA_FACES:
+        if face_name not in self.job.faces:
             raise ValueError(f"Invalid face name: {face_name}")
 
-        angles = PANORAMA_FACES[face_name]
+        angles = self.job.faces[face_name]
         cfg_file = self._generate_render_cfg(face_name, angles)
+        start_tick, frame_offset, frame_limit = self.job.frame_window(DEFAULT_START_TICK)
         
         self._cleanup_game_artifacts(face_name)
         
-        logger.info(f"--- Starting Render: {face_name} {angles} ---")
+        self.logger.info(f"--- Starting Render: {face_name} {angles} ---")
+        if frame_offset or frame_limit:
+            self.logger.info(f"Tick range: {start_tick} -> {self.cfg.END_TICK or 'end'} (frames from {frame_offset})")
         
         cmd = [
-            str(cfg.GAME_EXE),
-            "-game", cfg.MOD_DIR,
+            str(self.cfg.GAME_EXE),
+            "-game", self.cfg.MOD_DIR,
             "-novid",
-            "-window", "-w", str(cfg.CUBE_FACE_SIZE), "-h", str(cfg.CUBE_FACE_SIZE),
+            "-window", "-w", str(self.cfg.CUBE_FACE_SIZE), "-h", str(self.cfg.CUBE_FACE_SIZE),
             "+exec", cfg_file
         ]
 
         try:
-            logger.info(f"Launching: {' '.join(cmd)}")
-            process = subprocess.Popen(cmd, cwd=cfg.GAME_ROOT)
+            self.logger.info(f"Launching: {' '.join(cmd)}")
+            process = subprocess.Popen(cmd, cwd=self.cfg.GAME_ROOT)
             
             # Automation Sequence (Timing can be adjusted if loading is slow)
             time.sleep(20)
-            logger.info("Injecting F8 (Play Demo)...")
+            self.logger.info("Injecting F8 (Play Demo)...")
             press_key(0x77) 
             time.sleep(15)
-            logger.info("Injecting F9 (Unlock)...")
+            self.logger.info("Injecting F9 (Unlock)...")
             press_key(0x78)
             time.sleep(1)
-            logger.info("Injecting F10 (Set View)...")
+            self.logger.info("Injecting F10 (Set View)...")
             press_key(0x79)
             time.sleep(2)
-            logger.info("Injecting F11 (Start Record)...")
+            self.logger.info("Injecting F11 (Start Record)...")
             press_key(0x7A)
             
             # --- MONITORING LOOP (Same as before) ---
-            monitor_paths = {cfg.GAME_ROOT / cfg.MOD_DIR, cfg.GAME_ROOT / "hl2"}
-            monitor_paths = [p for p in monitor_paths if p.exists()]
+            monitor_paths = [p for p in self._search_paths() if p.exists()]
             tga_pattern = f"{face_name}*.tga"
             
             last_hash = ""
             stability_cycles = 0
+            # Catches shader compile stalls, crash dialogs and missed F-keys
+            watchdog = FrameWatchdog(face_name, monitor_paths, self.cfg.WATCHDOG_TIMEOUT)
             
             time.sleep(5)
             
             while True:
+                # HL2 stays in the menu after the demo, so it only exits through F12 below
                 if process.poll() is not None:
+                    raise RenderCrashError(
+                        f"Game exited before {face_name} was finished (exit code {process.returncode}, "
+                        f"{watchdog.count()} frames)"
+                    )
+
+                watchdog.check()
+
+                if frame_limit and watchdog.frame_count >= frame_limit:
+                    self.logger.info(f"End tick {self.cfg.END_TICK} reached. Finishing...")
+                    press_key(0x7B) # F12
+                    try: process.wait(timeout=10)
+                    except: process.terminate()
                     break
                 
                 try:
@@ -156,7 +189,7 @@ class EngineController:
                         last_hash = current_hash
                     
                     if stability_cycles >= 15:
-                        logger.info("Menu detected. Finishing...")
+                        self.logger.info("Menu detected. Finishing...")
                         press_key(0x7B) # F12
                         try: process.wait(timeout=10)
                         except: process.terminate()
@@ -165,60 +198,77 @@ class EngineController:
                 time.sleep(2.0)
             
             # Move files (Convert TGA -> JPEG) with GPU attempt
-            logger.info(f"Processing files for {face_name}...")
-            search_paths = [cfg.GAME_ROOT / cfg.MOD_DIR, cfg.GAME_ROOT / "hl2"]
-            for mod_path in search_paths:
+            self.logger.info(f"Processing files for {face_name}...")
+            face_dir = self.job.storage.face_dir(face_name)
+            for mod_path in self._search_paths():
                 if not mod_path.exists(): continue
                 
-                # 1. Identify TGA files
+                # 1. Identify TGA files (frames past the end tick are dropped)
+                if frame_limit:
+                    for f in list_tga_frames(mod_path, face_name)[frame_limit:]:
+                        try: f.unlink()
+                        except: pass
                 tga_files = list(mod_path.glob(f"{face_name}*.tga"))
                 if not tga_files:
                     continue
 
-                # 2. Batch Convert using FFmpeg (Sequence Pattern)
-                input_pattern = mod_path / f"{face_name}%04d.tga"
-                output_pattern = cfg.TEMP_DIR / f"{face_name}%04d.jpg"
+                if self.cfg.STITCH_SOURCE == "tga":
+                    # 2. Keep raw TGA frames; the stitcher streams them directly
+                    self.logger.info(f"Moving {len(tga_files)} raw TGA frames for {face_name}...")
+                    for i, f in enumerate(list_tga_frames(mod_path, face_name)):
+                        shutil.move(str(f), face_dir / f"{face_name}{i + frame_offset:04d}.tga")
+                else:
+                    # 2. Batch Convert using FFmpeg (Sequence Pattern)
+                    input_pattern = mod_path / f"{face_name}%04d.tga"
+                    output_pattern = face_dir / f"{face_name}%04d.jpg"
+                    # Number output frames from the window start so they splice into the full sequence
+                    output_numbering = ["-start_number", str(frame_offset)]
                 
-                logger.info(f"Batch converting {len(tga_files)} frames for {face_name}...")
+                    self.logger.info(f"Batch converting {len(tga_files)} frames for {face_name}...")
                 
-                cmd_base_args = [cfg.FFMPEG_BIN, "-y", "-i", str(input_pattern)]
+                    cmd_base_args = [self.cfg.FFMPEG_BIN, "-y", "-i", str(input_pattern)]
 
-                # Try NVENC first (as requested), fallback to CPU
-                try:
-                    # Attempt to use mjpeg_nvenc if available (rare, but satisfies request structure)
-                    cmd_nvenc = cmd_base_args + [
-                        "-c:v", "mjpeg_nvenc", 
-                        "-q:v", "2", 
-                        str(output_pattern)
-                    ]
-                    # logger.info("Attempting NVENC encoding...") 
-                    subprocess.run(cmd_nvenc, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    logger.info("NVENC encoding successful.")
-                except subprocess.CalledProcessError:
-                    # Fallback to standard CPU MJPEG
-                    cmd_cpu = cmd_base_args + [
-                        "-c:v", "mjpeg",
-                        "-q:v", "2",
-                        str(output_pattern)
-                    ]
+                    # Try NVENC first (as requested), fallback to CPU
                     try:
-                        subprocess.run(cmd_cpu, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    except subprocess.CalledProcessError as e:
-                        logger.error(f"CPU encoding failed for {face_name}: {e}")
-                        raise e
-
-                # 3. Cleanup TGA files
-                for f in tga_files:
-                    try: f.unlink()
-                    except: pass
+                        # Attempt to use mjpeg_nvenc if available (rare, but satisfies request structure)
+                        cmd_nvenc = cmd_base_args + [
+                            "-c:v", "mjpeg_nvenc", 
+                            "-q:v", "2", 
+                            *output_numbering,
+                            str(output_pattern)
+                        ]
+                        # self.logger.info("Attempting NVENC encoding...") 
+                        subprocess.run(cmd_nvenc, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                        self.logger.info("NVENC encoding successful.")
+                    except subprocess.CalledProcessError:
+                        # Fallback to standard CPU MJPEG
+                        cmd_cpu = cmd_base_args + [
+                            "-c:v", "mjpeg",
+                            "-q:v", "2",
+                            *output_numbering,
+                            str(output_pattern)
+                        ]
+                        try:
+                            subprocess.run(cmd_cpu, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                        except subprocess.CalledProcessError as e:
+                            self.logger.error(f"CPU encoding failed for {face_name}: {e}")
+                            raise e
+
+                    # 3. Cleanup TGA files
+                    for f in tga_files:
+                        try: f.unlink()
+                        except: pass
                 
                 # Move Audio
                 wav_file = mod_path / f"{face_name}.wav"
                 if wav_file.exists():
-                    target_wav = cfg.TEMP_DIR / f"{face_name}.wav"
+                    target_wav = face_dir / self.job.audio_file_name(face_name, DEFAULT_START_TICK)
                     shutil.move(str(wav_file), target_wav)
 
         except Exception as e:
-            logger.error(f"Render failed for {face_name}: {e}")
-            if process.poll() is None: process.terminate()
+            self.logger.error(f"Render failed for {face_name}: {e}")
+            if process.poll() is None:
+                process.kill()
+                try: process.wait(timeout=10)
+                except: pass
             raise
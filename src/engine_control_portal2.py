@@ -2,33 +2,43 @@ import math
 import subprocess
 import time
 import shutil
-from config import cfg, PANORAMA_FACES
-from src.utils import logger
 from src.window_input import press_key
+from src.watchdog import FrameWatchdog, RenderCrashError
+from src.raw_frames import list_tga_frames
+
+# Tick the full render starts from; frame 0 of every face sequence
+DEFAULT_START_TICK = 100
 
 class EngineController:
     """Controls the game engine (Portal 2) to render frames."""
     
-    def __init__(self):
+    def __init__(self, job):
+        self.job = job
+        self.cfg = job.cfg
+        self.logger = job.logger
         # Config path: .../Portal 2/portal2/cfg
-        self.cfg_path = cfg.GAME_ROOT / cfg.MOD_DIR / "cfg"
+        self.cfg_path = self.cfg.GAME_ROOT / self.cfg.MOD_DIR / "cfg"
         self.autoexec = self.cfg_path / "autoexec.cfg"
         self.autoexec_bak = self.cfg_path / "autoexec.cfg.bak"
         
         if not self.cfg_path.exists():
-            logger.warning(f"Config directory not found at {self.cfg_path}.")
+            self.logger.warning(f"Config directory not found at {self.cfg_path}.")
             self.cfg_path.mkdir(parents=True, exist_ok=True)
 
+        # Optional RAM-disk staging for the raw capture; linked by RenderJob while it holds the game
+        self.capture_dir = None
+
     def _get_render_commands(self, face_name: str, angles: tuple) -> str:
         """Generates the content for the render config."""
         pitch, yaw, roll = angles
-        target_fov = cfg.RIG_FOV
+        target_fov = self.cfg.RIG_FOV
         rad_fov = math.radians(target_fov)
         source_val = 2 * math.atan(math.tan(rad_fov / 2) * (4 / 3))
         real_fov = math.degrees(source_val)
+        start_tick, _, _ = self.job.frame_window(DEFAULT_START_TICK)
         
-        logger.info(f"Generating config content for {face_name}")
-        logger.info(f"Using DEMO_FILE: {cfg.DEMO_FILE}")
+        self.logger.info(f"Generating config content for {face_name}")
+        self.logger.info(f"Using DEMO_FILE: {self.cfg.DEMO_FILE}")
 
         content = [
             f"echo \">>> LOADING RENDER CONFIG FOR {face_name} <<<\"", 
@@ -64,14 +74,17 @@ class EngineController:
             # --------------------------------------
 
             # Clear keys
-            "unbind F9", "unbind F10", "unbind F11",
+            "unbind F9", "unbind F10", "unbind F11", "unbind F12",
 
             # Binds
             f"bind \"F9\" \"sv_cheats 1; mat_vsync 0; fps_max 0; fov {real_fov}; cl_fov {real_fov}; thirdperson; c_mindistance -100; c_minyaw -360; c_maxyaw 360; c_minpitch -180; c_maxpitch 180\"",
-            f"bind \"F10\" \"demo_gototick 100; cam_idealdist 0; cam_idealdistright 0; cam_idealdistup 0; cam_collision 0; cam_ideallag 0; cam_snapto 1; c_thirdpersonshoulder 0; cam_idealpitch {-pitch}; cam_idealyaw {yaw}; demo_fov_override 0; demo_pause;\"",
-            f"bind \"F11\" \"fov {real_fov}; cl_fov {real_fov}; thirdperson_mayamode; host_framerate {cfg.FRAMERATE}; startmovie {face_name} tga wav; demo_quitafterplayback 1; demo_resume\"",
+            f"bind \"F10\" \"demo_gototick {start_tick}; cam_idealdist 0; cam_idealdistright 0; cam_idealdistup 0; cam_collision 0; cam_ideallag 0; cam_snapto 1; c_thirdpersonshoulder 0; cam_idealpitch {-pitch}; cam_idealyaw {yaw}; demo_fov_override 0; demo_pause;\"",
+            f"bind \"F11\" \"fov {real_fov}; cl_fov {real_fov}; thirdperson_mayamode; host_framerate {self.cfg.CAPTURE_FRAMERATE}; startmovie {self.job.storage.capture_name(face_name)} tga wav; demo_quitafterplayback 1; demo_resume\"",
 
-            f"playdemo {cfg.DEMO_FILE}",
+            # F12: Stop Record and Quit (used when an end tick is set)
+            "bind \"F12\" \"endmovie; quit\"",
+
+            f"playdemo {self.cfg.DEMO_FILE}",
 
             # Crucial for saving the state
             "host_writeconfig"
@@ -94,7 +107,7 @@ class EngineController:
             with open(self.autoexec, "w", encoding='utf-8') as f:
                 f.write(content)
         except Exception as e:
-            logger.error(f"Failed to setup autoexec: {e}")
+            self.logger.error(f"Failed to setup autoexec: {e}")
             raise
 
     def _restore_autoexec(self):
@@ -105,13 +118,19 @@ class EngineController:
             
             if self.autoexec_bak.exists():
                 shutil.move(self.autoexec_bak, self.autoexec) # Restore old one
-                logger.info("Restored original autoexec.cfg")
+                self.logger.info("Restored original autoexec.cfg")
         except Exception as e:
-            logger.error(f"Failed to restore autoexec: {e}")
+            self.logger.error(f"Failed to restore autoexec: {e}")
+
+    def _search_paths(self) -> list:
+        """Folders the engine may write movie frames into."""
+        paths = [self.cfg.GAME_ROOT / self.cfg.MOD_DIR, self.cfg.GAME_ROOT / "portal2"]
+        if self.capture_dir:
+            paths.insert(0, self.capture_dir)
+        return list(dict.fromkeys(paths))
 
     def _cleanup_game_artifacts(self, face_name: str):
-        search_paths = [cfg.GAME_ROOT / cfg.MOD_DIR, cfg.GAME_ROOT / "portal2"]
-        for mod_path in search_paths:
+        for mod_path in self._search_paths():
             if not mod_path.exists(): continue
             for f in mod_path.glob(f"{face_name}*.tga"):
                 try: f.unlink()
@@ -122,10 +141,11 @@ class EngineController:
                 except: pass
 
     def render_face(self, face_name: str):
-        if face_name not in PANORAMA_FACES:
+        if face_name not in self.job.faces:
             raise ValueError(f"Invalid face name: {face_name}")
 
-        angles = PANORAMA_FACES[face_name]
+        angles = self.job.faces[face_name]
+        start_tick, frame_offset, frame_limit = self.job.frame_window(DEFAULT_START_TICK)
         
         # 1. Generate content
         render_content = self._get_render_commands(face_name, angles)
@@ -135,84 +155,124 @@ class EngineController:
         
         self._cleanup_game_artifacts(face_name)
         
-        logger.info(f"--- Starting Render: {face_name} {angles} ---")
+        self.logger.info(f"--- Starting Render: {face_name} {angles} ---")
+        if frame_offset or frame_limit:
+            self.logger.info(f"Tick range: {start_tick} -> {self.cfg.END_TICK or 'end'} (frames from {frame_offset})")
         
         # Launch arguments
         cmd = [
-            str(cfg.GAME_EXE),
-            "-game", cfg.MOD_DIR,
+            str(self.cfg.GAME_EXE),
+            "-game", self.cfg.MOD_DIR,
             "-novid",
             "-nojoy",         # Disable joystick
-            "-window", "-w", str(cfg.CUBE_FACE_SIZE), "-h", str(cfg.CUBE_FACE_SIZE),
+            "-window", "-w", str(self.cfg.CUBE_FACE_SIZE), "-h", str(self.cfg.CUBE_FACE_SIZE),
         ]
 
         process = None
         try:
-            logger.info(f"Launching: {' '.join(cmd)}")
-            process = subprocess.Popen(cmd, cwd=cfg.GAME_ROOT)
+            self.logger.info(f"Launching: {' '.join(cmd)}")
+            process = subprocess.Popen(cmd, cwd=self.cfg.GAME_ROOT)
             
             # Wait for load. 
             time.sleep(20) 
             
-            logger.info("Injecting F10 (Set View)...")
+            self.logger.info("Injecting F10 (Set View)...")
             press_key(0x79)
             time.sleep(2)
 
-            logger.info("Injecting F9 (Unlock & Model)...")
+            self.logger.info("Injecting F9 (Unlock & Model)...")
             press_key(0x78)
             time.sleep(1)
             
-            logger.info("Injecting F11 (Start Record)...")
+            self.logger.info("Injecting F11 (Start Record)...")
             press_key(0x7A)
             
-            logger.info("Waiting for game process to exit...")
-            process.wait()
+            self.logger.info("Waiting for game process to exit...")
+            monitor_paths = [p for p in self._search_paths() if p.exists()]
+            watchdog = FrameWatchdog(face_name, monitor_paths, self.cfg.WATCHDOG_TIMEOUT)
+            stopped = False
+            while process.poll() is None:
+                watchdog.check()
+                if frame_limit and watchdog.frame_count >= frame_limit:
+                    self.logger.info(f"End tick {self.cfg.END_TICK} reached. Finishing...")
+                    press_key(0x7B) # F12
+                    try: process.wait(timeout=10)
+                    except: process.terminate()
+                    stopped = True
+                    break
+                time.sleep(2.0)
+
+            # demo_quitafterplayback exits cleanly; anything else is a crash
+            if not stopped:
+                frame_count = watchdog.count()
+                if process.returncode != 0 or frame_count == 0:
+                    raise RenderCrashError(
+                        f"Game exited before {face_name} was finished (exit code {process.returncode}, "
+                        f"{frame_count} frames)"
+                    )
             
             # Conversion logic (no changes)
-            logger.info(f"Processing files for {face_name}...")
-            search_paths = [cfg.GAME_ROOT / cfg.MOD_DIR, cfg.GAME_ROOT / "portal2"]
-            for mod_path in search_paths:
+            self.logger.info(f"Processing files for {face_name}...")
+            face_dir = self.job.storage.face_dir(face_name)
+            for mod_path in self._search_paths():
                 if not mod_path.exists(): continue
                 
+                # Frames past the end tick are dropped
+                if frame_limit:
+                    for f in list_tga_frames(mod_path, face_name)[frame_limit:]:
+                        try: f.unlink()
+                        except: pass
                 tga_files = list(mod_path.glob(f"{face_name}*.tga"))
                 if not tga_files:
                     continue
 
-                input_pattern = mod_path / f"{face_name}%04d.tga"
-                output_pattern = cfg.TEMP_DIR / f"{face_name}%04d.jpg"
+                if self.cfg.STITCH_SOURCE == "tga":
+                    self.logger.info(f"Moving {len(tga_files)} raw TGA frames for {face_name}...")
+                    for i, f in enumerate(list_tga_frames(mod_path, face_name)):
+                        shutil.move(str(f), face_dir / f"{face_name}{i + frame_offset:04d}.tga")
+                else:
+                    input_pattern = mod_path / f"{face_name}%04d.tga"
+                    output_pattern = face_dir / f"{face_name}%04d.jpg"
+                    # Number output frames from the window start so they splice into the full sequence
+                    output_numbering = ["-start_number", str(frame_offset)]
                 
-                logger.info(f"Batch converting {len(tga_files)} frames for {face_name}...")
+                    self.logger.info(f"Batch converting {len(tga_files)} frames for {face_name}...")
                 
-                cmd_base_args = [cfg.FFMPEG_BIN, "-y", "-i", str(input_pattern)]
-
-                try:
-                    cmd_nvenc = cmd_base_args + [
-                        "-c:v", "mjpeg_nvenc", 
-                        "-q:v", "2", 
-                        str(output_pattern)
-                    ]
-                    subprocess.run(cmd_nvenc, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                except subprocess.CalledProcessError:
-                    cmd_cpu = cmd_base_args + [
-                        "-c:v", "mjpeg", 
-                        "-q:v", "2", 
-                        str(output_pattern)
-                    ]
-                    subprocess.run(cmd_cpu, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-                for f in tga_files:
-                    try: f.unlink()
-                    except: pass
+                    cmd_base_args = [self.cfg.FFMPEG_BIN, "-y", "-i", str(input_pattern)]
+
+                    try:
+                        cmd_nvenc = cmd_base_args + [
+                            "-c:v", "mjpeg_nvenc", 
+                            "-q:v", "2", 
+                            *output_numbering,
+                            str(output_pattern)
+                        ]
+                        subprocess.run(cmd_nvenc, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    except subprocess.CalledProcessError:
+                        cmd_cpu = cmd_base_args + [
+                            "-c:v", "mjpeg", 
+                            "-q:v", "2", 
+                            *output_numbering,
+                            str(output_pattern)
+                        ]
+                        subprocess.run(cmd_cpu, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+                    for f in tga_files:
+                        try: f.unlink()
+                        except: pass
                 
                 wav_file = mod_path / f"{face_name}.wav"
                 if wav_file.exists():
-                    target_wav = cfg.TEMP_DIR / f"{face_name}.wav"
+                    target_wav = face_dir / self.job.audio_file_name(face_name, DEFAULT_START_TICK)
                     shutil.move(str(wav_file), target_wav)
 
 
         except Exception as e:
-            logger.error(f"Render failed for {face_name}: {e}")
-            if process and process.poll() is None: process.terminate()
+            self.logger.error(f"Render failed for {face_name}: {e}")
+            if process and process.poll() is None:
+                process.kill()
+                try: process.wait(timeout=10)
+                except: pass
             raise
         finally:
             # Always restore autoexec
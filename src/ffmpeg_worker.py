@@ -1,101 +1,551 @@
+import math
+import re
 import subprocess
 import shutil
 from pathlib import Path
-from config import cfg, PANORAMA_FACES, get_v360_angle
-from src.utils import logger
+from config import get_v360_angle
+from src.raw_frames import RawFaceFeeder, list_tga_frames, read_tga_info
+from src.spherical import inject_spherical_metadata
+
+# OUTPUT_PROJECTION -> v360 output format
+V360_OUTPUTS = {
+    "equirect": "equirect",
+    "cubemap": "c3x2",
+    "eac": "eac",
+}
+
+FINAL_ENCODERS = [
+    ("NVENC", ["-c:v", "hevc_nvenc", "-pix_fmt", "yuv420p", "-preset", "p7", "-cq", "18", "-forced-idr", "1"]),
+    ("CPU", ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18"]),
+]
+
+# Used when the output is too wide for NVENC (tiled) or to match HEVC segments
+HEVC_CPU_ENCODER = ("CPU (HEVC)", ["-c:v", "libx265", "-pix_fmt", "yuv420p", "-crf", "18"])
+
+# Widest frame hevc_nvenc accepts; H.264 levels stop at 8192 as well
+NVENC_MAX_WIDTH = 8192
+
+# Encoder -> codec name reported by ffprobe
+ENCODER_CODECS = {"hevc_nvenc": "hevc", "libx265": "hevc", "libx264": "h264"}
+
+# Stream properties that must match across segments to join them with stream copy
+SEGMENT_PARAMS = {
+    # Different encoders of one codec (hevc_nvenc / libx265) differ in profile, level and
+    # parameter sets; concat keeps only the first file's extradata
+    "v:0": ["codec_name", "profile", "level", "extradata_hash", "width", "height", "pix_fmt", "r_frame_rate"],
+    "a:0": ["codec_name", "sample_rate", "channels"],
+}
+
+# Segments get a keyframe every second so they can be cut with stream copy
+SEGMENT_KEYFRAME_ARGS = ["-force_key_frames", "expr:gte(t,n_forced)"]
+
+# INTERPOLATION -> filter raising the captured rate to the output rate
+INTERPOLATION_FILTERS = {
+    "mci": "minterpolate=fps={fps}:mi_mode=mci:mc_mode=aobmc:me_mode=bidir:vsbmc=1",
+    "blend": "framerate=fps={fps}",
+    "dup": "fps={fps}",
+}
+
+LOSSLESS_ENCODERS = [
+    ("FFV1", ["-c:v", "ffv1", "-level", "3", "-pix_fmt", "yuv420p"]),
+]
+
+
+def _face_overlaps_stripe(angles: tuple, centre: float, lon_width: float, rig_fov: float, blend_width: float) -> bool:
+    """Checks whether a rig camera (v360 pitch/yaw) can contribute to a longitude stripe."""
+    pitch, yaw = angles
+    # Angular radius of the (square) face footprint: centre to corner
+    half_fov = math.radians(rig_fov / 2)
+    radius = math.degrees(math.atan(math.sqrt(2) * math.tan(half_fov)))
+    if abs(pitch) + radius >= 90:
+        return True  # Footprint contains a pole, so it spans every longitude
+
+    lon_half = math.degrees(math.asin(min(1.0, math.sin(math.radians(radius)) / math.cos(math.radians(pitch)))))
+    # Margin for the blend zone
+    lon_half *= 1 + blend_width
+    distance = abs((yaw - centre + 180) % 360 - 180)
+    return distance <= lon_half + lon_width / 2
 
 class FFmpegStitcher:
     """Handles the stitching of panoramic faces."""
     
-    def __init__(self):
-        self.ffmpeg_bin = shutil.which(cfg.FFMPEG_BIN)
+    def __init__(self, job):
+        self.job = job
+        self.cfg = job.cfg
+        self.logger = job.logger
+        self.ffmpeg_bin = shutil.which(self.cfg.FFMPEG_BIN)
         if not self.ffmpeg_bin:
             raise RuntimeError("FFmpeg not found.")
+        self._video_extra_args = []
+        self.interpolation = self._interpolation_filter()
 
-    def stitch(self):
-        logger.info(f"--- Starting Panorama Stitching (Multi-Angle Mode: {len(PANORAMA_FACES)} inputs) ---")
-        
+    def stitch(self, output_file: Path = None, segment: bool = False):
+        """
+        Stitches the captured faces. With `segment`, the video gets a keyframe every
+        second so it can later be joined and cut with stream copy (see concat).
+        """
+        self._video_extra_args = SEGMENT_KEYFRAME_ARGS if segment else []
+        self.logger.info(f"--- Starting Panorama Stitching (Multi-Angle Mode: {len(self.job.faces)} inputs) ---")
+
+        faces = self._collect_faces()
+
+        # Audio (Use the first available or a specific one like row0_yaw0)
+        audio_path = self._audio_track(faces[0])
+
+        out_w, out_h = self._output_size()
+        if output_file is None:
+            output_file = self.cfg.output_path / f"{self.cfg.OUTPUT_NAME}.mp4"
+
+        # Stripes are longitude ranges, so tiling only applies to equirect output
+        tiles = self._tile_count(out_w) if self.cfg.OUTPUT_PROJECTION == "equirect" else 1
+        if tiles > 1:
+            self._stitch_tiled(faces, out_w, out_h, tiles, audio_path, output_file)
+        else:
+            self._stitch_pass(faces, out_w, out_h, "", audio_path, output_file, self._final_encoders(out_w),
+                              interpolate=self.cfg.INTERPOLATION_STAGE == "stitched")
+
+        # Separate stripe streams are not a full sphere each, leave them untagged
+        if not (tiles > 1 and self.cfg.TILE_OUTPUT == "streams"):
+            inject_spherical_metadata(output_file, self.cfg.OUTPUT_PROJECTION, self.logger)
+
+        self.logger.info(f"Done! Output: {output_file}")
+
+    def _final_encoders(self, out_w: int) -> list:
+        """Final encoders for a given width; beyond NVENC's limit libx265 comes before libx264."""
+        if out_w > NVENC_MAX_WIDTH:
+            return [HEVC_CPU_ENCODER] + FINAL_ENCODERS[1:]
+        return FINAL_ENCODERS + [HEVC_CPU_ENCODER]
+
+    def _audio_track(self, face: dict):
+        """
+        The face's full audio track, or its tick-window tracks joined in tick order
+        (time shards). Each window is padded or cut to reach the next window's start.
+        """
+        full = face["dir"] / f"{face['name']}.wav"
+        if full.exists():
+            return full
+
+        pattern = re.compile(rf"{re.escape(face['name'])}_tick(\d+)\.wav")
+        shards = sorted(
+            (int(m.group(1)), p) for p in face["dir"].glob(f"{face['name']}_tick*.wav")
+            if (m := pattern.fullmatch(p.name))
+        )
+        if not shards:
+            return None
+        if len(shards) == 1:
+            return shards[0][1]
+
+        self.logger.info(f"Joining {len(shards)} audio windows for {face['name']} (ticks {', '.join(str(t) for t, _ in shards)})")
         inputs = []
-        input_pads = []
-        angles_list = []
-        
-        # Sort faces to ensure consistent order (optional but good for debugging)
-        # We just need to iterate them and match indices.
-        faces_order = sorted(list(PANORAMA_FACES.keys()))
-        
+        chains = []
+        for i, (tick, path) in enumerate(shards):
+            inputs.extend(["-i", str(path)])
+            if i < len(shards) - 1:
+                duration = (shards[i + 1][0] - tick) / self.cfg.DEMO_TICKRATE
+                chains.append(f"[{i}:a]apad,atrim=end={duration:.6f}[a{i}]")
+            else:
+                chains.append(f"[{i}:a]anull[a{i}]")
+        pads = "".join(f"[a{i}]" for i in range(len(shards)))
+        chains.append(f"{pads}concat=n={len(shards)}:v=0:a=1[outa]")
+
+        audio_dir = self.cfg.TEMP_DIR / "audio"
+        audio_dir.mkdir(parents=True, exist_ok=True)
+        joined = audio_dir / f"{face['name']}.wav"
+        subprocess.run([
+            self.ffmpeg_bin, "-y", *inputs,
+            "-filter_complex", ";".join(chains), "-map", "[outa]", "-c:a", "pcm_s16le",
+            str(joined)
+        ], check=True)
+        return joined
+
+    def _output_size(self) -> tuple:
+        """Output resolution matching the pixel density of the captured faces."""
+        if self.cfg.OUTPUT_PROJECTION not in V360_OUTPUTS:
+            raise ValueError(f"Unknown OUTPUT_PROJECTION: {self.cfg.OUTPUT_PROJECTION}")
+
+        if self.cfg.OUTPUT_PROJECTION == "equirect":
+            out_w = int((360.0 / self.cfg.RIG_FOV) * self.cfg.CUBE_FACE_SIZE)
+            return out_w, int(out_w / 2)
+
+        # Cube faces span 90 degrees each, laid out 3x2
+        face = int(round((90.0 / self.cfg.RIG_FOV) * self.cfg.CUBE_FACE_SIZE / 2)) * 2
+        return face * 3, face * 2
+
+    def _interpolation_filter(self) -> str:
+        """Filter that converts CAPTURE_FRAMERATE to FRAMERATE, or "" when both match."""
+        if self.cfg.CAPTURE_FRAMERATE == self.cfg.FRAMERATE:
+            return ""
+        if self.cfg.INTERPOLATION not in INTERPOLATION_FILTERS:
+            raise ValueError(f"Unknown INTERPOLATION: {self.cfg.INTERPOLATION}")
+        if self.cfg.INTERPOLATION_STAGE not in ("stitched", "faces"):
+            raise ValueError(f"Unknown INTERPOLATION_STAGE: {self.cfg.INTERPOLATION_STAGE}")
+
+        self.logger.info(
+            f"Interpolating {self.cfg.CAPTURE_FRAMERATE} -> {self.cfg.FRAMERATE} fps "
+            f"({self.cfg.INTERPOLATION}, {self.cfg.INTERPOLATION_STAGE})"
+        )
+        return INTERPOLATION_FILTERS[self.cfg.INTERPOLATION].format(fps=self.cfg.FRAMERATE)
+
+    def _collect_faces(self) -> list:
+        """Locates the frames of every face and resolves its v360 angles."""
+        faces = []
         missing_files = False
-        
-        for idx, face_name in enumerate(faces_order):
-            # Input pattern for sequence
-            input_pattern = cfg.TEMP_DIR / f"{face_name}%04d.jpg"
-            
-            # Check for existence
-            if not list(cfg.TEMP_DIR.glob(f"{face_name}*.jpg")):
-                logger.error(f"Missing frames for face: {face_name}")
-                missing_files = True
-                continue
-                
-            # Add Input
-            inputs.extend(["-framerate", str(cfg.FRAMERATE), "-i", str(input_pattern)])
-            input_pads.append(f"[{idx}:v]")
-            
+        raw_mode = self.cfg.STITCH_SOURCE == "tga"
+
+        # Sort faces to ensure consistent order (optional but good for debugging)
+        for face_name in sorted(list(self.job.faces.keys())):
+            # Faces may be striped across several volumes (see src/storage.py)
+            face_dir = self.job.storage.locate(face_name)
+            face = {"name": face_name, "dir": face_dir, "raw": None, "args": []}
+
+            if raw_mode:
+                # Raw TGA frames are streamed through named pipes (see _run)
+                frames = list_tga_frames(face_dir, face_name)
+                if not frames:
+                    self.logger.error(f"Missing frames for face: {face_name}")
+                    missing_files = True
+                    continue
+                face["raw"] = (face_name, frames, read_tga_info(frames[0]))
+            else:
+                # Input pattern for sequence
+                input_pattern = face_dir / f"{face_name}%04d.jpg"
+
+                # Check for existence
+                if not list(face_dir.glob(f"{face_name}*.jpg")):
+                    self.logger.error(f"Missing frames for face: {face_name}")
+                    missing_files = True
+                    continue
+                face["args"] = ["-framerate", str(self.cfg.CAPTURE_FRAMERATE), "-i", str(input_pattern)]
+
             # Get Angles from config
-            src_pitch, src_yaw, _ = PANORAMA_FACES[face_name]
-            v_pitch, v_yaw = get_v360_angle(src_pitch, src_yaw)
-            
-            angles_list.append(f"{v_pitch} {v_yaw}")
-            
+            src_pitch, src_yaw, _ = self.job.faces[face_name]
+            face["angles"] = get_v360_angle(src_pitch, src_yaw)
+            faces.append(face)
+
         if missing_files:
             raise FileNotFoundError("Critical files missing. Aborting stitch.")
+        return faces
 
-        # Audio (Use the first available or a specific one like row0_yaw0)
-        audio_face = faces_order[0]
-        audio_path = cfg.TEMP_DIR / f"{audio_face}.wav"
-        has_audio = False
-        audio_input_idx = len(faces_order)
-        
-        if audio_path.exists():
-            inputs.extend(["-i", str(audio_path)])
-            has_audio = True
+    def _stitch_pass(self, faces: list, out_w: int, out_h: int, view_opts: str,
+                     audio_path, output_file: Path, encoders: list, interpolate: bool = False):
+        """
+        Stitches the given faces into one equirect (or partial equirect) video.
+        With `interpolate`, the stitched video is raised to the output framerate here;
+        with INTERPOLATION_STAGE 'faces', every face is interpolated before v360.
+        """
+        inputs = []
+        raw_faces = []
+        input_pads = []
+        face_chains = []
+        angles_list = []
+        interpolate_faces = self.interpolation and self.cfg.INTERPOLATION_STAGE == "faces"
+
+        for idx, face in enumerate(faces):
+            pad = f"[{idx}:v]"
+            face_filters = []
+            if face["raw"]:
+                raw_faces.append(face["raw"])
+                # Source writes bottom-up TGAs; rawvideo has no orientation flag
+                if not face["raw"][2].top_down:
+                    face_filters.append("vflip")
+            else:
+                inputs.extend(face["args"])
+            if interpolate_faces:
+                face_filters.append(self.interpolation)
+            if face_filters:
+                face_chains.append(f"{pad}{','.join(face_filters)}[face{idx}]")
+                pad = f"[face{idx}]"
+            input_pads.append(pad)
+
+            v_pitch, v_yaw = face["angles"]
+            angles_list.append(f"{v_pitch} {v_yaw}")
 
         # Build Filter
         cam_angles_str = " ".join(angles_list)
         pads_str = "".join(input_pads)
-        
-        # Calculate Output Resolution
-        out_w = int((360.0 / cfg.RIG_FOV) * cfg.CUBE_FACE_SIZE)
-        out_h = int(out_w / 2)
-        
+
         v360_filter = (
-            f"v360=input=tiles:output=equirect:interp=lanczos"
+            f"v360=input=tiles:output={V360_OUTPUTS[self.cfg.OUTPUT_PROJECTION]}:interp=lanczos"
             f":w={out_w}:h={out_h}"
+            f"{view_opts}"
             f":cam_angles='{cam_angles_str}'"
-            f":rig_fov={cfg.RIG_FOV}"
-            f":blend_width={cfg.BLEND_WIDTH}"
-            f"[outv]"
+            f":rig_fov={self.cfg.RIG_FOV}"
+            f":blend_width={self.cfg.BLEND_WIDTH}"
         )
-        
-        filter_complex = f"{pads_str}{v360_filter}"
-        output_file = cfg.output_path / f"{cfg.OUTPUT_NAME}.mp4"
+        if interpolate and self.interpolation:
+            v360_filter += f",{self.interpolation}"
+
+        filter_complex = ";".join(face_chains + [f"{pads_str}{v360_filter}[outv]"])
+        output_args = ["-filter_complex", filter_complex, "-map", "[outv]"]
+
+        if audio_path:
+            inputs.extend(["-i", str(audio_path)])
+            output_args.extend(["-map", f"{len(faces)}:a", "-c:a", "aac", "-b:a", "320k"])
+
+        self._encode(inputs, output_args, raw_faces, encoders, output_file)
+
+    def _encode(self, inputs: list, output_args: list, raw_faces: list, encoders: list, output_file: Path):
+        """Tries each (label, codec args) encoder in order until one succeeds."""
+        for attempt, (label, codec_args) in enumerate(encoders):
+            try:
+                self.logger.info(f"Encoding with {label}...")
+                video_args = codec_args + self._video_extra_args if codec_args else []
+                self._run(inputs, output_args + video_args + [str(output_file)], raw_faces)
+                return
+            except subprocess.CalledProcessError:
+                if attempt == len(encoders) - 1:
+                    raise
+                self.logger.warning(f"{label} failed, trying {encoders[attempt + 1][0]}...")
+
+    def _tile_count(self, out_w: int) -> int:
+        """Number of vertical stripes; 0 in config means auto (stripes no wider than STITCH_TILE_WIDTH)."""
+        if self.cfg.STITCH_TILES > 0:
+            return self.cfg.STITCH_TILES
+        return max(1, math.ceil(out_w / self.cfg.STITCH_TILE_WIDTH))
+
+    def _stitch_tiled(self, faces: list, out_w: int, out_h: int, tiles: int, audio_path, output_file: Path):
+        """
+        Splits the equirect canvas into vertical (longitude) stripes. Each stripe is a
+        partial equirect (v360 h_fov + yaw) stitched only from the faces that reach it,
+        so memory is bounded by the stripe size instead of the full canvas.
+        """
+        # Stripe widths: even, summing to out_w
+        base = (out_w // tiles) & ~1
+        widths = [base] * (tiles - 1) + [out_w - base * (tiles - 1)]
+        self.logger.info(f"Tiled stitch: {out_w}x{out_h} as {tiles} stripes {widths}")
+
+        tile_dir = self.cfg.TEMP_DIR / "tiles"
+        tile_dir.mkdir(exist_ok=True)
+        stream_mode = self.cfg.TILE_OUTPUT == "streams"
+        tile_ext = "mp4" if stream_mode else "mkv"
+        # Stripes are re-encoded once more when assembled, so keep them lossless
+        tile_encoders = FINAL_ENCODERS if stream_mode else LOSSLESS_ENCODERS
+
+        tile_files = []
+        left = 0
+        for i, width in enumerate(widths):
+            # v360 yaw: 0 is the canvas centre, the left edge sits at -180
+            lon_start = left * 360.0 / out_w - 180.0
+            lon_width = width * 360.0 / out_w
+            centre = lon_start + lon_width / 2
+            left += width
+
+            stripe_faces = [f for f in faces if _face_overlaps_stripe(f["angles"], centre, lon_width, self.cfg.RIG_FOV, self.cfg.BLEND_WIDTH)]
+            self.logger.info(f"Stripe {i + 1}/{tiles}: yaw {centre:.1f} (+/-{lon_width / 2:.1f}), {len(stripe_faces)} faces")
+
+            tile_file = tile_dir / f"{self.cfg.OUTPUT_NAME}_tile{i:02d}.{tile_ext}"
+            view_opts = f":h_fov={lon_width}:v_fov=180:yaw={centre}"
+            # Copied stripes are final, so they are interpolated one by one
+            self._stitch_pass(stripe_faces, width, out_h, view_opts, None, tile_file, tile_encoders,
+                              interpolate=stream_mode and self.cfg.INTERPOLATION_STAGE == "stitched")
+            tile_files.append(tile_file)
+
+        inputs = []
+        for tile_file in tile_files:
+            inputs.extend(["-i", str(tile_file)])
+        output_args = []
+        if stream_mode:
+            # Multi-stream output: stripes are copied side by side as separate video streams
+            for i in range(tiles):
+                output_args.extend(["-map", f"{i}:v"])
+            output_args.extend(["-c:v", "copy"])
+            encoders = [("stream copy", [])]
+        else:
+            pads = "".join(f"[{i}:v]" for i in range(tiles))
+            assemble_filter = f"{pads}hstack=inputs={tiles}"
+            # Interpolating the assembled canvas keeps motion estimation seamless across stripes
+            if self.interpolation and self.cfg.INTERPOLATION_STAGE == "stitched":
+                assemble_filter += f",{self.interpolation}"
+            output_args.extend(["-filter_complex", f"{assemble_filter}[outv]", "-map", "[outv]"])
+            encoders = self._final_encoders(out_w)
+
+        if audio_path:
+            inputs.extend(["-i", str(audio_path)])
+            output_args.extend(["-map", f"{tiles}:a", "-c:a", "aac", "-b:a", "320k"])
+
+        self._encode(inputs, output_args, [], encoders, output_file)
+
+        for tile_file in tile_files:
+            try: tile_file.unlink()
+            except: pass
+
+    def concat(self, segments: list, output_file: Path, crossfade: int = 0):
+        """
+        Joins stitched segments with stream copy. With `crossfade` (whole seconds), only
+        the seconds around each cut are re-encoded with an xfade; everything else is copied.
+        """
+        self.logger.info(f"--- Joining {len(segments)} segments into {output_file} ---")
+        params = self._check_segments(segments)
+        join_dir = self.cfg.TEMP_DIR / "join"
+        join_dir.mkdir(parents=True, exist_ok=True)
+
+        parts = list(segments)
+        if crossfade > 0 and len(segments) > 1:
+            parts = self._crossfade_parts(segments, join_dir, crossfade, params)
+            # Re-encoded transitions must match the segments as well
+            self._check_segments(parts)
+
+        list_file = join_dir / "segments.txt"
+        with open(list_file, "w", encoding="utf-8") as f:
+            for part in parts:
+                escaped = Path(part).resolve().as_posix().replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
 
         cmd = [
             self.ffmpeg_bin, "-y",
-            *inputs,
-            "-filter_complex", filter_complex,
-            "-map", "[outv]"
+            "-f", "concat", "-safe", "0", "-i", str(list_file),
+            "-map", "0", "-c", "copy",
+            str(output_file)
         ]
+        subprocess.run(cmd, check=True)
+        inject_spherical_metadata(output_file, self.cfg.OUTPUT_PROJECTION, self.logger)
+
+        for part in parts:
+            if Path(part).parent == join_dir:
+                try: Path(part).unlink()
+                except: pass
+        self.logger.info(f"Done! Output: {output_file}")
+
+    def _check_segments(self, segments: list) -> dict:
+        """
+        Probes every segment and raises if any differs from the first in codec, size,
+        pixel format, frame rate or audio layout; stream copy would silently produce a broken file.
+        Returns the common parameters as {"v:0.codec_name": ..., ...}.
+        """
+        reference = None
+        for segment in segments:
+            params = {
+                f"{stream}.{entry}": self._probe(segment, f"stream={entry}", stream)
+                for stream, entries in SEGMENT_PARAMS.items()
+                for entry in entries
+            }
+            if reference is None:
+                reference = params
+                continue
+            diffs = [f"{k}: {params[k] or 'none'} (expected {reference[k] or 'none'})" for k in params if params[k] != reference[k]]
+            if diffs:
+                raise RuntimeError(
+                    f"Segment {segment} does not match {segments[0]} ({'; '.join(diffs)}). "
+                    f"Delete the mismatched segment so it is rendered again with the current settings."
+                )
+        return reference
+
+    def _crossfade_parts(self, segments: list, join_dir: Path, crossfade: int, params: dict) -> list:
+        """Splits segments into copied bodies and re-encoded crossfades around each cut."""
+        durations = [self._probe(s, "format=duration") for s in segments]
+        durations = [float(d) for d in durations]
+        encoders = self._segment_encoders(segments[0], params["v:0.codec_name"])
+        has_audio = bool(params["a:0.codec_name"])
+        self._video_extra_args = SEGMENT_KEYFRAME_ARGS
+
+        parts = []
+        last = len(segments) - 1
+        for i, segment in enumerate(segments):
+            # Keyframes sit on whole seconds, so all copy cuts are whole seconds too
+            head = crossfade if i > 0 else 0
+            tail = math.floor(durations[i] - crossfade) if i < last else durations[i]
+            if tail - head <= 0:
+                raise ValueError(f"Segment {segment} is too short for a {crossfade}s crossfade.")
+
+            body = join_dir / f"part{i:03d}_body.mp4"
+            subprocess.run([
+                self.ffmpeg_bin, "-y",
+                "-ss", str(head), "-i", str(segment), "-t", str(tail - head),
+                "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero",
+                str(body)
+            ], check=True)
+            parts.append(body)
+
+            if i == last:
+                break
 
-        if has_audio:
-            cmd.extend(["-map", f"{audio_input_idx}:a", "-c:a", "aac", "-b:a", "320k"])
-        
-        # NVENC encoding
+            # Transition: the rest of this segment fades into the first seconds of the next
+            fade_in = durations[i] - tail
+            transition = join_dir / f"part{i:03d}_xfade.mp4"
+            inputs = [
+                "-ss", str(tail), "-i", str(segment),
+                "-t", str(crossfade), "-i", str(segments[i + 1]),
+            ]
+            filter_complex = f"[0:v][1:v]xfade=transition=fade:duration={crossfade}:offset={fade_in - crossfade}[outv]"
+            output_args = ["-map", "[outv]"]
+            if has_audio:
+                filter_complex += f";[0:a][1:a]acrossfade=d={crossfade}[outa]"
+                output_args.extend(["-map", "[outa]", "-c:a", "aac", "-b:a", "320k"])
+            output_args = ["-filter_complex", filter_complex] + output_args
+
+            self.logger.info(f"Crossfading segment {i + 1} -> {i + 2} ({crossfade}s)...")
+            self._encode(inputs, output_args, [], encoders, transition)
+            parts.append(transition)
+
+        return parts
+
+    def _segment_encoders(self, segment: Path, codec: str) -> list:
+        """
+        Encoders for transitions: the one the segments were made with (from the encoder
+        tag the muxer writes), so the re-encoded parts carry the same parameter sets.
+        """
+        tag = self._probe(segment, "stream_tags=encoder", "v:0")
+        candidates = FINAL_ENCODERS + [HEVC_CPU_ENCODER]
+        for encoder in candidates:
+            if tag.split(" ")[-1] == encoder[1][1]:
+                return [encoder]
+
+        # Untagged segments: any encoder of the codec; the parts check in concat catches a mismatch
+        self.logger.warning(f"Segment encoder unknown (tag '{tag}'), picking one by codec '{codec}'.")
+        encoders = [e for e in candidates if ENCODER_CODECS.get(e[1][1]) == codec]
+        if not encoders:
+            raise RuntimeError(f"No encoder configured for segment codec '{codec}'.")
+        return encoders
+
+    def _probe(self, path: Path, entry: str, stream: str = None) -> str:
+        """Reads a single value with ffprobe (shipped next to ffmpeg)."""
+        ffmpeg_path = Path(self.ffmpeg_bin)
+        ffprobe_bin = ffmpeg_path.with_name(ffmpeg_path.name.replace("ffmpeg", "ffprobe"))
+        if not ffprobe_bin.exists():
+            ffprobe_bin = shutil.which("ffprobe")
+        if not ffprobe_bin:
+            raise RuntimeError("ffprobe not found.")
+
+        cmd = [str(ffprobe_bin), "-v", "error"]
+        if stream:
+            cmd.extend(["-select_streams", stream])
+        if "extradata_hash" in entry:
+            cmd.extend(["-show_data_hash", "md5"])
+        cmd.extend(["-show_entries", entry, "-of", "default=noprint_wrappers=1:nokey=1", str(path)])
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        lines = result.stdout.strip().splitlines()
+        return lines[0] if lines else ""
+
+    def _run(self, inputs: list, output_args: list, raw_faces: list):
+        """Runs FFmpeg; raw faces are prepended as rawvideo pipe inputs."""
+        if not raw_faces:
+            subprocess.run([self.ffmpeg_bin, "-y", *inputs, *output_args], check=True)
+            return
+
+        # Pipes are single-use, so every attempt gets fresh feeders
+        feeders = [
+            RawFaceFeeder(face_name, frames, info, self.cfg.RAW_READAHEAD_FRAMES, self.logger)
+            for face_name, frames, info in raw_faces
+        ]
         try:
-            cmd_nvenc = cmd + ["-c:v", "hevc_nvenc", "-pix_fmt", "yuv420p", "-preset", "p7", "-cq", "18", str(output_file)]
-            logger.info("Encoding with NVENC...")
-            subprocess.run(cmd_nvenc, check=True)
-        except subprocess.CalledProcessError:
-            logger.warning("NVENC failed, using CPU...")
-            cmd_cpu = cmd + ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18", str(output_file)]
-            subprocess.run(cmd_cpu, check=True)
-
-        logger.info(f"Done! Output: {output_file}")
+            raw_inputs = []
+            for feeder in feeders:
+                raw_inputs.extend(feeder.input_args(self.cfg.CAPTURE_FRAMERATE))
+
+            self.logger.info(f"Streaming raw TGA frames for {len(feeders)} faces (read-ahead {self.cfg.RAW_READAHEAD_FRAMES})...")
+            process = subprocess.Popen([self.ffmpeg_bin, "-y", *raw_inputs, *inputs, *output_args])
+            for feeder in feeders:
+                feeder.start()
+            returncode = process.wait()
+        finally:
+            for feeder in feeders:
+                feeder.stop()
+
+        failed = [feeder for feeder in feeders if feeder.error]
+        for feeder in failed:
+            self.logger.warning(f"Raw feed for {feeder.face_name} ended early: {feeder.error}")
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, process.args)
+        if failed:
+            # A short face would end the stitch early or leave it out of sync
+            raise RuntimeError(f"Raw feed failed for {', '.join(f.face_name for f in failed)}.")
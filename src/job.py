@@ -0,0 +1,197 @@
+import threading
+from config import RenderConfig, build_panorama_faces
+from src.utils import logger, JobLogger, install_player_model
+from src.storage import FaceStorage
+from src.ffmpeg_worker import FFmpegStitcher
+from src.watchdog import RenderSupervisor
+
+# Game instances are driven by simulated key presses on the focused window,
+# so only one job at a time may run a game. Stitching is not serialized.
+ENGINE_LOCK = threading.Lock()
+
+# TEMP_DIRs and volume folders of running jobs; two jobs writing the same frames would corrupt each other
+_active_temp_dirs = set()
+_active_lock = threading.Lock()
+
+
+class RenderJob:
+    """
+    One render with its own config, face layout, paths, storage and logger.
+    Jobs share no module state, so several can run in one process (threads, or
+    asyncio through run_in_executor) as long as each has its own TEMP_DIR.
+    """
+
+    def __init__(self, config: RenderConfig = None, name: str = None, **overrides):
+        # Always a private copy: the job changes DEMO_FILE per segment
+        config = RenderConfig(**overrides) if config is None else config.copy(**overrides)
+
+        self.cfg = config
+        self.name = name or config.OUTPUT_NAME
+        self.faces = build_panorama_faces(config.PANORAMA_MODE)
+        self.output_path = config.output_path
+        self.temp_dir = config.TEMP_DIR
+        self.logger = JobLogger(logger, {"job": self.name})
+        self.storage = FaceStorage.from_config(config, self.logger)
+
+    def ticks_to_frames(self, ticks: int) -> int:
+        """Converts a number of demo ticks into captured movie frames."""
+        return round(ticks / self.cfg.DEMO_TICKRATE * self.cfg.CAPTURE_FRAMERATE)
+
+    def frame_window(self, first_tick: int) -> tuple:
+        """
+        Returns (start_tick, frame_offset, frame_limit) for the configured tick range.
+        Frames are numbered relative to the engine's first demo tick so a partial render
+        splices into the full per-face sequence; frame_limit 0 means "until the demo ends".
+        """
+        start_tick = self.cfg.START_TICK or first_tick
+        if start_tick < first_tick:
+            raise ValueError(f"START_TICK {start_tick} is before the first demo tick ({first_tick}).")
+        if self.cfg.END_TICK and self.cfg.END_TICK <= start_tick:
+            raise ValueError(f"END_TICK {self.cfg.END_TICK} must be after the start tick ({start_tick}).")
+
+        frame_offset = self.ticks_to_frames(start_tick - first_tick)
+        # A non-empty window records at least one frame (0 would mean "until the end")
+        frame_limit = max(1, self.ticks_to_frames(self.cfg.END_TICK - start_tick)) if self.cfg.END_TICK else 0
+        return start_tick, frame_offset, frame_limit
+
+    def audio_file_name(self, face_name: str, first_tick: int) -> str:
+        """
+        Only a full render provides the face's track ({face}.wav); any tick window keeps
+        its audio as {face}_tick<start>.wav, which the stitcher joins when no full track exists.
+        """
+        start_tick, frame_offset, frame_limit = self.frame_window(first_tick)
+        if frame_offset == 0 and frame_limit == 0:
+            return f"{face_name}.wav"
+        return f"{face_name}_tick{start_tick}.wav"
+
+    def run(self, stitch_only: bool = False, demos: list = None) -> bool:
+        """Renders and stitches the job. Returns True on success."""
+        # Volume subfolders are named after TEMP_DIR, so they can collide even when TEMP_DIRs differ
+        keys = {p.resolve() for p in (self.temp_dir, *self.storage.volumes)}
+        with _active_lock:
+            shared = keys & _active_temp_dirs
+            if shared:
+                raise RuntimeError(
+                    f"Another job is already using {', '.join(str(p) for p in sorted(shared))}. "
+                    f"Give each job its own TEMP_DIR (with a unique folder name when using TEMP_VOLUMES)."
+                )
+            _active_temp_dirs.update(keys)
+        try:
+            return self._run(stitch_only, demos)
+        finally:
+            with _active_lock:
+                _active_temp_dirs.difference_update(keys)
+
+    def _run(self, stitch_only: bool, demos: list) -> bool:
+        self.logger.info(f"=== Source Panorama Renderer (FOV {self.cfg.RIG_FOV}) ===")
+        self.logger.info(f"Total Angles to Render: {len(self.faces)}")
+
+        if not self.cfg.GAME_EXE.exists():
+            self.logger.error(f"HL2 Executable not found at: {self.cfg.GAME_EXE}")
+            return False
+
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            stitcher = FFmpegStitcher(self)
+        except Exception as e:
+            self.logger.error(f"Stitcher Init failed: {e}")
+            return False
+
+        if demos is None:
+            demos = [d.strip() for d in self.cfg.DEMO_FILES.split(",") if d.strip()]
+        if demos:
+            try:
+                self._run_segments(demos, stitcher, stitch_only)
+                return True
+            except KeyboardInterrupt:
+                self.logger.warning("Interrupted.")
+            except Exception as e:
+                self.logger.error(f"Error: {e}")
+            return False
+
+        if not stitch_only:
+            try:
+                engine = self.create_engine()
+                # 1. Render Phase
+                self.render_faces(engine)
+            except Exception as e:
+                self.logger.error(f"Render Phase failed: {e}")
+                return False
+        else:
+            self.logger.info("Skipping Render Phase (--stitch-only active)")
+
+        try:
+            # 2. Stitch Phase
+            self.logger.info("Phase 2: Stitching Video...")
+            stitcher.stitch()
+            return True
+        except KeyboardInterrupt:
+            self.logger.warning("Interrupted.")
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+        return False
+
+    def create_engine(self):
+        # Install/Verify player model to prevent player rendering
+        install_player_model(self.cfg.GAME_ROOT, self.cfg.MOD_DIR)
+
+        if self.cfg.ENGINE_TYPE == "portal2":
+            from src.engine_control_portal2 import EngineController, DEFAULT_START_TICK
+            self.logger.info("Loaded Portal 2 Engine Controller")
+        else:
+            from src.engine_control import EngineController, DEFAULT_START_TICK
+            self.logger.info("Loaded HL2 Engine Controller")
+
+        # Reject a bad tick range before any game is launched (and retried)
+        self.frame_window(DEFAULT_START_TICK)
+
+        return EngineController(self)
+
+    def render_faces(self, engine):
+        self.logger.info("Phase 1: Rendering Panorama Faces...")
+        supervisor = RenderSupervisor(
+            engine, self.cfg.RENDER_RETRIES, self.cfg.RETRY_BACKOFF,
+            self.output_path / f"{self.cfg.OUTPUT_NAME}_{self.cfg.DEMO_FILE}_render_report.json",
+            self.logger
+        )
+        sorted_faces = sorted(list(self.faces.keys()))
+        if ENGINE_LOCK.locked():
+            self.logger.info("Waiting for another job to release the game...")
+        with ENGINE_LOCK:
+            # The capture link lives in the shared mod folder, so it is only touched under the lock
+            engine.capture_dir = self.storage.prepare_capture(self.cfg.GAME_ROOT / self.cfg.MOD_DIR)
+            for i, face in enumerate(sorted_faces):
+                self.logger.info(f"Progress: {i+1}/{len(sorted_faces)} ({face})")
+                supervisor.render_face(face)
+
+    def _run_segments(self, demos: list, stitcher, stitch_only: bool):
+        """Renders and stitches each demo into its own segment, then joins them with stream copy."""
+        segment_dir = self.output_path / "segments"
+        segment_dir.mkdir(exist_ok=True)
+        engine = None if stitch_only else self.create_engine()
+
+        segments = []
+        for i, demo in enumerate(demos):
+            segment_file = segment_dir / f"{self.cfg.OUTPUT_NAME}_{demo}.mp4"
+            segments.append(segment_file)
+            self.logger.info(f"=== Segment {i+1}/{len(demos)}: {demo} ===")
+
+            # Already stitched segments are reused, so adding a chapter costs one demo
+            if segment_file.exists():
+                self.logger.info(f"Reusing existing segment: {segment_file}")
+                continue
+            if stitch_only:
+                raise FileNotFoundError(f"Segment for '{demo}' not found (--stitch-only only joins existing segments).")
+
+            # Frames of the previous demo must not leak into this one
+            self.storage.cleanup()
+
+            self.cfg.DEMO_FILE = demo
+            self.render_faces(engine)
+            self.logger.info("Phase 2: Stitching Segment...")
+            stitcher.stitch(segment_file, segment=True)
+
+        self.logger.info("Phase 3: Joining Segments...")
+        stitcher.concat(segments, self.output_path / f"{self.cfg.OUTPUT_NAME}.mp4", self.cfg.CROSSFADE_SECONDS)
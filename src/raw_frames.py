@@ -0,0 +1,319 @@
+import mmap
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from src.utils import logger
+
+# TGA header layout (18 bytes):
+# id_len, cmap_type, img_type, cmap_first, cmap_len, cmap_depth, x0, y0, width, height, bpp, descriptor
+TGA_HEADER = struct.Struct("<BBBHHBHHHHBB")
+TGA_TRUECOLOR = 2
+
+
+class TgaInfo:
+    """Geometry of an uncompressed TGA frame."""
+
+    def __init__(self, width: int, height: int, bpp: int, header_len: int, top_down: bool):
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.header_len = header_len
+        self.top_down = top_down
+
+    @property
+    def pix_fmt(self) -> str:
+        return "bgra" if self.bpp == 32 else "bgr24"
+
+    @property
+    def frame_size(self) -> int:
+        return self.width * self.height * (self.bpp // 8)
+
+
+def read_tga_info(path: Path) -> TgaInfo:
+    """Parses the TGA header. Only uncompressed true-color frames can be streamed raw."""
+    with open(path, "rb") as f:
+        header = f.read(TGA_HEADER.size)
+    if len(header) < TGA_HEADER.size:
+        raise ValueError(f"Truncated TGA header: {path}")
+
+    (id_len, cmap_type, img_type, _, cmap_len, cmap_depth,
+     _, _, width, height, bpp, descriptor) = TGA_HEADER.unpack(header)
+
+    if img_type != TGA_TRUECOLOR or bpp not in (24, 32):
+        raise ValueError(f"Unsupported TGA (type {img_type}, {bpp} bpp): {path}")
+
+    cmap_bytes = cmap_len * ((cmap_depth + 7) // 8) if cmap_type else 0
+    header_len = TGA_HEADER.size + id_len + cmap_bytes
+    # Descriptor bit 5: origin at the top-left. Source writes bottom-up frames.
+    top_down = bool(descriptor & 0x20)
+    return TgaInfo(width, height, bpp, header_len, top_down)
+
+
+def list_tga_frames(directory: Path, face_name: str) -> list:
+    """Returns the TGA frames of one face, ordered by frame number."""
+    frames = []
+    for f in directory.glob(f"{face_name}*.tga"):
+        suffix = f.stem[len(face_name):]
+        if suffix.isdigit():
+            frames.append((int(suffix), f))
+    frames.sort()
+    return [f for _, f in frames]
+
+
+class _FifoPipe:
+    """POSIX named pipe (mkfifo)."""
+
+    def __init__(self, name: str):
+        self._dir = tempfile.mkdtemp(prefix="panorama_pipes_")
+        self.path = os.path.join(self._dir, name)
+        os.mkfifo(self.path)
+        self._fd = None
+
+    def connect(self):
+        # Blocks until FFmpeg opens the pipe for reading
+        self._fd = os.open(self.path, os.O_WRONLY)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+
+    def cancel(self):
+        # Unblock a writer still waiting in connect()
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+
+    def close(self):
+        if self._fd is not None:
+            try: os.close(self._fd)
+            except OSError: pass
+            self._fd = None
+        try:
+            os.unlink(self.path)
+            os.rmdir(self._dir)
+        except OSError:
+            pass
+
+
+class _WindowsPipe:
+    """Windows named pipe (\\\\.\\pipe\\...), created through the Win32 API."""
+
+    PIPE_ACCESS_OUTBOUND = 0x00000002
+    PIPE_TYPE_BYTE = 0x00000000
+    PIPE_WAIT = 0x00000000
+    GENERIC_READ = 0x80000000
+    OPEN_EXISTING = 3
+    ERROR_PIPE_CONNECTED = 535
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, name: str):
+        import ctypes
+        from ctypes import wintypes
+        self._ctypes = ctypes
+        self._k32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._k32.CreateNamedPipeW.restype = wintypes.HANDLE
+        self._k32.CreateFileW.restype = wintypes.HANDLE
+        self._invalid = wintypes.HANDLE(-1).value
+
+        # Unique per instance: several jobs in one process may stream the same face name
+        self.path = f"\\\\.\\pipe\\panorama_{os.getpid()}_{uuid.uuid4().hex[:8]}_{name}"
+        self._handle = self._k32.CreateNamedPipeW(
+            self.path, self.PIPE_ACCESS_OUTBOUND, self.PIPE_TYPE_BYTE | self.PIPE_WAIT,
+            1, self.BUFFER_SIZE, self.BUFFER_SIZE, 0, None
+        )
+        if self._handle in (None, self._invalid):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def connect(self):
+        if not self._k32.ConnectNamedPipe(self._handle, None):
+            err = self._ctypes.get_last_error()
+            if err != self.ERROR_PIPE_CONNECTED:
+                raise self._ctypes.WinError(err)
+
+    def write(self, data):
+        ctypes = self._ctypes
+        view = memoryview(data)
+        # Borrow the mapped memory directly; the mapping is opened copy-on-write so it is writable
+        buf = (ctypes.c_char * len(view)).from_buffer(view)
+        try:
+            offset = 0
+            written = ctypes.c_ulong(0)
+            while offset < len(view):
+                ok = self._k32.WriteFile(
+                    self._handle, ctypes.byref(buf, offset),
+                    len(view) - offset, ctypes.byref(written), None
+                )
+                if not ok:
+                    raise ctypes.WinError(ctypes.get_last_error())
+                offset += written.value
+        finally:
+            del buf
+
+    def cancel(self):
+        # Connect a dummy client so a pending ConnectNamedPipe returns
+        handle = self._k32.CreateFileW(self.path, self.GENERIC_READ, 0, None, self.OPEN_EXISTING, 0, None)
+        if handle not in (None, self._invalid):
+            self._k32.CloseHandle(handle)
+
+    def close(self):
+        if self._handle:
+            self._k32.FlushFileBuffers(self._handle)
+            self._k32.DisconnectNamedPipe(self._handle)
+            self._k32.CloseHandle(self._handle)
+            self._handle = None
+
+
+def create_pipe(name: str):
+    """Creates a named pipe FFmpeg can open as a regular input path."""
+    if sys.platform == "win32":
+        return _WindowsPipe(name)
+    return _FifoPipe(name)
+
+
+def _close_map(mm: mmap.mmap):
+    try:
+        mm.close()
+    except BufferError:
+        # A failed write's traceback still holds a view; the map is freed with it
+        pass
+
+
+class RawFaceFeeder:
+    """
+    Streams one face's TGA sequence into FFmpeg as rawvideo.
+    A reader thread memory-maps frames ahead of the writer (bounded by `readahead`),
+    the writer pushes the pixel payload (header stripped) through a named pipe.
+    """
+
+    def __init__(self, face_name: str, frames: list, info: TgaInfo, readahead: int, log=logger):
+        self.face_name = face_name
+        self.logger = log
+        self.frames = frames
+        self.info = info
+        self.pipe = create_pipe(face_name)
+        self._queue = queue.Queue(maxsize=max(1, readahead))
+        self._stop = threading.Event()
+        self._threads = []
+        self.error = None
+
+    def input_args(self, framerate: int) -> list:
+        return [
+            "-f", "rawvideo",
+            "-pixel_format", self.info.pix_fmt,
+            "-video_size", f"{self.info.width}x{self.info.height}",
+            "-framerate", str(framerate),
+            "-i", self.pipe.path,
+        ]
+
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._read_ahead, name=f"read-{self.face_name}", daemon=True),
+            threading.Thread(target=self._write, name=f"pipe-{self.face_name}", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self):
+        while not self._stop.is_set():
+            try:
+                return self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def _read_ahead(self):
+        previous = None
+        try:
+            for frame in self.frames:
+                mm = self._map(frame)
+                if mm is None:
+                    # Dropping the frame would shift this face against the others and the audio
+                    if previous is None:
+                        raise ValueError(f"Truncated frame with no previous frame to repeat: {frame}")
+                    self.logger.warning(f"Truncated frame, repeating {previous.name}: {frame}")
+                    mm = self._map(previous)
+                else:
+                    previous = frame
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_WILLNEED)
+                if not self._put(mm):
+                    mm.close()
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _map(self, frame: Path):
+        """Maps a frame, or returns None if it is too short to hold a full image."""
+        with open(frame, "rb") as f:
+            # Checked before mapping: empty files (a killed game) cannot be mapped at all
+            if os.fstat(f.fileno()).st_size < self.info.header_len + self.info.frame_size:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def _write(self):
+        start = self.info.header_len
+        end = start + self.info.frame_size
+        try:
+            self.pipe.connect()
+            while not self._stop.is_set():
+                mm = self._get()
+                if mm is None:
+                    break
+                try:
+                    with memoryview(mm) as view:
+                        self.pipe.write(view[start:end])
+                finally:
+                    _close_map(mm)
+        except OSError as e:
+            # FFmpeg closed its end (finished early or failed)
+            if not self._stop.is_set():
+                self.error = e
+        finally:
+            self._stop.set()
+            self.pipe.close()
+            self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                mm = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if mm is not None:
+                _close_map(mm)
+
+    def stop(self):
+        """Aborts feeding (e.g. FFmpeg exited) and waits for the threads."""
+        self._stop.set()
+        deadline = time.monotonic() + 5
+        for t in self._threads:
+            # The writer may still be blocked waiting for FFmpeg to open the pipe
+            while t.is_alive() and time.monotonic() < deadline:
+                self.pipe.cancel()
+                t.join(timeout=0.2)
+        self._drain()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
@@ -0,0 +1,301 @@
+import math
+import os
+import shutil
+import struct
+import zlib
+from pathlib import Path
+from src.utils import logger
+
+# Boxes we descend into while looking for the video sample entry
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stsd"}
+# Bytes between the box header and the first child box
+CHILD_OFFSETS = {b"stsd": 8}
+# VisualSampleEntry fields before its child boxes
+VISUAL_ENTRY_OFFSET = 78
+METADATA_SOURCE = b"Source Panorama Renderer\0"
+
+# Quads per edge of each EAC face in the mesh projection; the tangent warp is smooth
+EAC_MESH_SUBDIVISIONS = 8
+# v360 pads EAC faces by 2 pixels at the frame border and between the two rows
+EAC_PIXEL_PAD = 2
+
+
+class Box:
+    """An MP4 box; containers keep their children parsed, leaves keep raw payload."""
+
+    def __init__(self, box_type: bytes, prefix: bytes = b"", children=None, data: bytes = b""):
+        self.type = box_type
+        self.prefix = prefix
+        self.children = children
+        self.data = data
+
+    def find(self, box_type: bytes):
+        for child in self.children or []:
+            if child.type == box_type:
+                return child
+        return None
+
+    def serialize(self) -> bytes:
+        if self.children is None:
+            payload = self.data
+        else:
+            payload = self.prefix + b"".join(c.serialize() for c in self.children)
+        return struct.pack(">I4s", 8 + len(payload), self.type) + payload
+
+
+def _full_box(box_type: bytes, payload: bytes) -> Box:
+    # version 0, flags 0
+    return Box(box_type, data=b"\0\0\0\0" + payload)
+
+
+class _BitWriter:
+    """Big-endian bit packer for the mesh box."""
+
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value: int, bits: int):
+        self.value = (self.value << bits) | value
+        self.bits += bits
+
+    def align(self):
+        self.write(0, -self.bits % 8)
+
+    def getvalue(self) -> bytes:
+        self.align()
+        return self.value.to_bytes(self.bits // 8, "big")
+
+
+def _zigzag(delta: int) -> int:
+    return delta * 2 if delta >= 0 else -delta * 2 - 1
+
+
+def _eac_direction(face: int, a: float, b: float) -> tuple:
+    """
+    Direction of a point on an EAC face, following v360's layout (top: left, front, right;
+    bottom: down, back, up, rotated). a/b are tangent-space coordinates in [-1, 1].
+    Returned in Spherical Video V2 axes: +x right, +y up, -z forward.
+    """
+    # v360 axes: +x right, +y down, +z forward
+    x, y, z = [
+        (-1.0, b, a),
+        (a, b, 1.0),
+        (1.0, b, -a),
+        (-b, 1.0, -a),
+        (-b, -a, -1.0),
+        (-b, -1.0, a),
+    ][face]
+    norm = math.sqrt(x * x + y * y + z * z)
+    return x / norm, -y / norm, -z / norm
+
+
+def _eac_mesh(width: int, height: int) -> bytes:
+    """Payload of a 'mesh' box describing a v360 EAC frame of the given size (one triangle list)."""
+    u_pad = EAC_PIXEL_PAD / width
+    v_pad = EAC_PIXEL_PAD / height
+    steps = EAC_MESH_SUBDIVISIONS
+
+    vertices = []
+    indices = []
+    for face in range(6):
+        u_face, v_face = face % 3, face // 3
+        first = len(vertices)
+        for row in range(steps + 1):
+            for col in range(steps + 1):
+                local_u = col / steps - 0.5
+                local_v = row / steps - 0.5
+                x, y, z = _eac_direction(face, math.tan(math.pi / 2 * local_u), math.tan(math.pi / 2 * local_v))
+                # Inverse of v360's padded face placement; mesh v runs bottom to top
+                u = (u_face + local_u + 0.5) * (1 - 2 * u_pad) / 3 + u_pad
+                v = (local_v + 0.5) * (0.5 - 2 * v_pad) + v_pad + 0.5 * v_face
+                vertices.append((x, y, z, u, 1.0 - v))
+        for row in range(steps):
+            for col in range(steps):
+                i = first + row * (steps + 1) + col
+                j = i + steps + 1
+                indices.extend([i, j, i + 1, i + 1, j, j + 1])
+
+    # All vertex components index into one shared, deduplicated float pool
+    pool = sorted({struct.pack(">f", c) for vertex in vertices for c in vertex})
+    lookup = {c: i for i, c in enumerate(pool)}
+
+    out = _BitWriter()
+    out.write(len(pool), 32)
+    for c in pool:
+        out.write(int.from_bytes(c, "big"), 32)
+
+    out.write(len(vertices), 32)
+    coord_bits = math.ceil(math.log2(len(pool) * 2))
+    previous = [0] * 5
+    for vertex in vertices:
+        for k, c in enumerate(vertex):
+            index = lookup[struct.pack(">f", c)]
+            out.write(_zigzag(index - previous[k]), coord_bits)
+            previous[k] = index
+    out.align()
+
+    out.write(1, 32)  # vertex lists
+    out.write(0, 8)   # texture_id
+    out.write(0, 8)   # index_type: triangles
+    out.write(len(indices), 32)
+    vertex_bits = math.ceil(math.log2(len(vertices) * 2))
+    previous = 0
+    for index in indices:
+        out.write(_zigzag(index - previous), vertex_bits)
+        previous = index
+    return out.getvalue()
+
+
+def _parse_boxes(data: bytes) -> list:
+    boxes = []
+    pos = 0
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - pos
+        payload = data[pos + header:pos + size]
+
+        if box_type in CONTAINERS:
+            offset = CHILD_OFFSETS.get(box_type, 0)
+            boxes.append(Box(box_type, payload[:offset], _parse_boxes(payload[offset:])))
+        else:
+            boxes.append(Box(box_type, data=payload))
+        pos += size
+    return boxes
+
+
+def _top_level_boxes(f) -> list:
+    """Returns (type, offset, size) of every top-level box without reading payloads."""
+    boxes = []
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+        elif size == 0:
+            size = file_size - pos
+        boxes.append((box_type, pos, size))
+        pos += size
+    return boxes
+
+
+def _projection_boxes(projection: str, width: int, height: int) -> list:
+    """Spherical Video V2 boxes (st3d + sv3d) for a mono video."""
+    if projection == "equirect":
+        # Full sphere: all bounds 0
+        proj_box = _full_box(b"equi", struct.pack(">IIII", 0, 0, 0, 0))
+    elif projection == "cubemap":
+        # Layout 0 (3x2: right, left, up / down, front, back), no padding
+        proj_box = _full_box(b"cbmp", struct.pack(">II", 0, 0))
+    else:
+        # EAC has no projection box of its own; describe it as a mesh ('raw ' encoding)
+        meshes = Box(b"mesh", data=_eac_mesh(width, height)).serialize()
+        payload = b"raw " + meshes
+        proj_box = _full_box(b"mshp", struct.pack(">I", zlib.crc32(payload)) + payload)
+
+    prhd = _full_box(b"prhd", struct.pack(">iii", 0, 0, 0))
+    sv3d = Box(b"sv3d", children=[
+        _full_box(b"svhd", METADATA_SOURCE),
+        Box(b"proj", children=[prhd, proj_box]),
+    ])
+    st3d = _full_box(b"st3d", b"\0")
+    return [st3d, sv3d]
+
+
+def _shift_chunk_offsets(box: Box, delta: int):
+    for child in box.children or []:
+        if child.type == b"stco":
+            count = struct.unpack(">I", child.data[4:8])[0]
+            offsets = struct.unpack(f">{count}I", child.data[8:8 + 4 * count])
+            child.data = child.data[:8] + struct.pack(f">{count}I", *(o + delta for o in offsets))
+        elif child.type == b"co64":
+            count = struct.unpack(">I", child.data[4:8])[0]
+            offsets = struct.unpack(f">{count}Q", child.data[8:8 + 8 * count])
+            child.data = child.data[:8] + struct.pack(f">{count}Q", *(o + delta for o in offsets))
+        else:
+            _shift_chunk_offsets(child, delta)
+
+
+def inject_spherical_metadata(path: Path, projection: str, log=logger) -> bool:
+    """
+    Tags the first video track of an MP4 as 360 video (Spherical Video V2: st3d + sv3d).
+    Supports 'equirect' (equi), 'cubemap' (cbmp) and 'eac' (mshp mesh). Returns False if nothing was written.
+    """
+    if projection not in ("equirect", "cubemap", "eac"):
+        log.warning(f"No Spherical Video V2 box for projection '{projection}', metadata not injected.")
+        return False
+
+    with open(path, "rb") as f:
+        top_level = _top_level_boxes(f)
+        moov_entry = next((b for b in top_level if b[0] == b"moov"), None)
+        if moov_entry is None:
+            log.warning(f"No moov box in {path}, metadata not injected.")
+            return False
+        _, moov_offset, moov_size = moov_entry
+        f.seek(moov_offset)
+        moov = _parse_boxes(f.read(moov_size))[0]
+
+    entry = None
+    for trak in moov.children:
+        if trak.type != b"trak":
+            continue
+        hdlr = trak.find(b"mdia").find(b"hdlr")
+        if hdlr is not None and hdlr.data[8:12] == b"vide":
+            stsd = trak.find(b"mdia").find(b"minf").find(b"stbl").find(b"stsd")
+            if stsd.children:
+                # Sample entries are kept raw while parsing; expand the video one
+                raw = stsd.children[0]
+                entry = Box(raw.type, raw.data[:VISUAL_ENTRY_OFFSET], _parse_boxes(raw.data[VISUAL_ENTRY_OFFSET:]))
+                stsd.children[0] = entry
+            break
+    if entry is None:
+        log.warning(f"No video track in {path}, metadata not injected.")
+        return False
+
+    entry.children = [c for c in entry.children if c.type not in (b"st3d", b"sv3d")]
+    # VisualSampleEntry: width and height follow 24 bytes of reserved and predefined fields
+    width, height = struct.unpack(">HH", entry.prefix[24:28])
+    entry.children.extend(_projection_boxes(projection, width, height))
+
+    new_moov = moov.serialize()
+    delta = len(new_moov) - moov_size
+    is_last = moov_offset + moov_size == top_level[-1][1] + top_level[-1][2]
+
+    if is_last:
+        # Common case (no faststart): rewrite the trailing moov in place
+        with open(path, "r+b") as f:
+            f.seek(moov_offset)
+            f.write(new_moov)
+            f.truncate()
+    else:
+        # moov sits before the media data: chunk offsets move by the size change
+        if any(b[0] == b"mdat" and b[1] > moov_offset for b in top_level):
+            _shift_chunk_offsets(moov, delta)
+            new_moov = moov.serialize()
+
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            for box_type, offset, size in top_level:
+                if box_type == b"moov":
+                    dst.write(new_moov)
+                    continue
+                src.seek(offset)
+                remaining = size
+                while remaining:
+                    chunk = src.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+        shutil.move(str(tmp_path), path)
+
+    log.info(f"Injected {projection} spherical metadata into {path}")
+    return True
@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from src.utils import logger, cleanup_temp
+
+INDEX_FILE = "face_index.json"
+# Folder inside the mod directory that points at the staging area
+CAPTURE_LINK = "panorama_capture"
+
+
+class FaceStorage:
+    """
+    Decides where each face's intermediate frames live.
+    Faces are striped across bulk volumes (round robin or by free space) and the
+    assignment is persisted in an index inside TEMP_DIR, so the stitcher can find
+    every face later. An optional staging dir (RAM disk / tmpfs) receives the raw
+    TGA capture through a link in the mod folder.
+    """
+
+    def __init__(self, temp_dir: Path, volumes: list, striping: str, staging_dir: Path = None, log=logger):
+        self.temp_dir = temp_dir
+        self.volumes = volumes or [temp_dir]
+        self.striping = striping
+        self.staging_dir = staging_dir
+        self.index_path = temp_dir / INDEX_FILE
+        self.logger = log
+
+    @classmethod
+    def from_config(cls, config, log=logger) -> "FaceStorage":
+        # cleanup() deletes TEMP_DIR and its volume subfolders, so neither may be a root or hold the project
+        temp_dir = config.TEMP_DIR.resolve()
+        if not temp_dir.name or Path.cwd().resolve().is_relative_to(temp_dir):
+            raise ValueError(f"TEMP_DIR must be a dedicated folder, not {config.TEMP_DIR} ({temp_dir}).")
+
+        return cls(
+            config.TEMP_DIR,
+            # Frames go into a subfolder of each volume, so cleanup never touches anything else there
+            [Path(v.strip()) / temp_dir.name for v in config.TEMP_VOLUMES.split(",") if v.strip()],
+            config.TEMP_STRIPING,
+            Path(config.STAGING_DIR) if config.STAGING_DIR else None,
+            log,
+        )
+
+    def _load_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.warning(f"Failed to read storage index {self.index_path}: {e}")
+            return {}
+
+    def _save_index(self, index: dict):
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.index_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+
+    def _pick_volume(self, index: dict) -> Path:
+        if self.striping == "free_space":
+            for v in self.volumes:
+                v.mkdir(parents=True, exist_ok=True)
+            return max(self.volumes, key=lambda v: shutil.disk_usage(v).free)
+        # Round robin in render order
+        return self.volumes[len(index) % len(self.volumes)]
+
+    def face_dir(self, face_name: str) -> Path:
+        """Directory for a face's frames, assigning a volume on first use."""
+        index = self._load_index()
+        current = [str(v) for v in self.volumes]
+        if index.get(face_name) not in current:
+            # Entries for volumes that are no longer configured are reassigned
+            index = {k: v for k, v in index.items() if v in current}
+            index[face_name] = str(self._pick_volume(index))
+            self._save_index(index)
+            self.logger.info(f"Storing {face_name} on {index[face_name]}")
+
+        path = Path(index[face_name])
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def locate(self, face_name: str) -> Path:
+        """Directory holding a face's frames (TEMP_DIR for frames rendered before the index existed)."""
+        path = self._load_index().get(face_name)
+        return Path(path) if path else self.temp_dir
+
+    def prepare_capture(self, mod_path: Path) -> Path:
+        """
+        Links <mod>/panorama_capture to the staging dir so `startmovie` writes into it.
+        Returns the capture directory, or None when no staging dir is configured.
+        A link left by another job is re-pointed; callers must hold the game (ENGINE_LOCK).
+        """
+        if not self.staging_dir:
+            return None
+
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        link = mod_path / CAPTURE_LINK
+        if os.path.lexists(link):
+            if link.resolve() == self.staging_dir.resolve():
+                return link
+            if link.resolve() == link.absolute():
+                raise RuntimeError(f"{link} is a regular folder, not a capture link. Remove it first.")
+            # Removes the link (or junction) itself, never the folder it points to
+            if link.is_symlink():
+                link.unlink()
+            else:
+                os.rmdir(link)
+
+        if sys.platform == "win32":
+            # Directory junctions need no admin rights, unlike symlinks
+            subprocess.run(
+                ["cmd", "/c", "mklink", "/J", str(link), str(self.staging_dir.resolve())],
+                check=True, stdout=subprocess.DEVNULL
+            )
+        else:
+            os.symlink(self.staging_dir.resolve(), link, target_is_directory=True)
+        self.logger.info(f"Capture staging: {link} -> {self.staging_dir}")
+        return link
+
+    def capture_name(self, face_name: str) -> str:
+        """Movie name passed to `startmovie` (relative to the mod folder)."""
+        if self.staging_dir:
+            return f"{CAPTURE_LINK}/{face_name}"
+        return face_name
+
+    def cleanup(self):
+        """Removes every face's frames from all volumes and the index."""
+        for path in {self.temp_dir, *self.volumes}:
+            cleanup_temp(path)
+            path.mkdir(parents=True, exist_ok=True)
+
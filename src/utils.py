@@ -18,6 +18,12 @@ def setup_logger():
 
 logger = setup_logger()
 
+class JobLogger(logging.LoggerAdapter):
+    """Prefixes every message with the job name, so concurrent jobs can be told apart."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['job']}] {msg}", kwargs
+
 def cleanup_temp(path: Path):
     """Removes a directory and its contents if it exists."""
     if path.exists():
@@ -0,0 +1,104 @@
+import json
+import subprocess
+import time
+from pathlib import Path
+from src.utils import logger
+
+
+class RenderHangError(RuntimeError):
+    """Raised when a game instance stops producing frames."""
+
+
+class RenderCrashError(RuntimeError):
+    """Raised when a game instance exits before the recording was finished."""
+
+
+class FrameWatchdog:
+    """Tracks frame production of one face and flags a hang when no new frames arrive in time."""
+
+    def __init__(self, face_name: str, monitor_paths: list, timeout: float):
+        self.face_name = face_name
+        self.monitor_paths = monitor_paths
+        self.timeout = timeout
+        self.frame_count = 0
+        self.last_progress = time.monotonic()
+
+    def count(self) -> int:
+        """Number of frames of the face written so far."""
+        count = 0
+        for p in self.monitor_paths:
+            count += sum(1 for _ in p.glob(f"{self.face_name}*.tga"))
+        return count
+
+    def check(self):
+        """Raises RenderHangError if the frame count did not grow within the timeout."""
+        count = self.count()
+
+        now = time.monotonic()
+        if count != self.frame_count:
+            self.frame_count = count
+            self.last_progress = now
+        elif now - self.last_progress > self.timeout:
+            raise RenderHangError(
+                f"No new frames for {self.face_name} in {self.timeout:.0f}s (stuck at {count} frames)"
+            )
+
+
+# Failures a fresh game instance can recover from; anything else is re-raised at once
+RETRYABLE_ERRORS = (RenderHangError, RenderCrashError, subprocess.CalledProcessError)
+
+
+class RenderSupervisor:
+    """Renders faces with retries and backoff, and records the outcome of every attempt."""
+
+    def __init__(self, engine, retries: int, backoff: float, report_path: Path, log=logger):
+        self.engine = engine
+        self.logger = log
+        self.retries = retries
+        self.backoff = backoff
+        self.report_path = report_path
+        self.outcomes = {}
+
+    def render_face(self, face_name: str):
+        attempts = []
+        self.outcomes[face_name] = attempts
+
+        for attempt in range(self.retries + 1):
+            started = time.time()
+            try:
+                self.engine.render_face(face_name)
+                attempts.append({"status": "ok", "seconds": round(time.time() - started, 1)})
+                self._save_report()
+                return
+            except Exception as e:
+                if isinstance(e, RenderHangError):
+                    status = "hang"
+                elif isinstance(e, RenderCrashError):
+                    status = "crash"
+                else:
+                    status = "error"
+                attempts.append({"status": status, "error": str(e), "seconds": round(time.time() - started, 1)})
+                self._save_report()
+
+                # Bad config, a missing face or a failed cfg write come back the same on every attempt
+                if not isinstance(e, RETRYABLE_ERRORS):
+                    raise
+
+                # Drop partial frames so the retry starts from a clean sequence
+                self.engine._cleanup_game_artifacts(face_name)
+
+                if attempt == self.retries:
+                    self.logger.error(f"Giving up on {face_name} after {attempt + 1} attempts.")
+                    raise
+
+                delay = self.backoff * (2 ** attempt)
+                self.logger.warning(f"Attempt {attempt + 1} for {face_name} failed ({status}). Retrying in {delay:.0f}s...")
+                time.sleep(delay)
+
+    def _save_report(self):
+        try:
+            with open(self.report_path, "w", encoding="utf-8") as f:
+                json.dump(self.outcomes, f, indent=2)
+        except IOError as e:
+            self.logger.warning(f"Failed to write render report {self.report_path}: {e}")
+